@@ -12,13 +12,12 @@ def convert(globstr, decoder_path, samples):
         encoded_texts = np.load(filepath)
         print('{}, {}'.format(filepath, encoded_texts.shape))
         text = '{}\n'.format(filepath)
-        for i in range(min(samples, len(encoded_texts))):
-            encoded_text = encoded_texts[i]
-            if len(encoded_text.shape) == 3:
-                encoded_text = encoded_text[0]
+        encoded_texts = encoded_texts[:samples]
+        if len(encoded_texts.shape) == 4:
+            encoded_texts = encoded_texts[:, 0]
 
-            cur_txt = decoder.decode(np.argmax(encoded_text, axis=0))
-            cur_txt = ''.join(cur_txt)
+        cur_txts = decoder.decode_batch(np.argmax(encoded_texts, axis=1))
+        for i, cur_txt in enumerate(cur_txts):
             text += '{}, {}\n'.format(i, cur_txt)
         with open(filepath+'.txt', "w") as text_file:
             text_file.write(text)
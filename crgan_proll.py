@@ -7,14 +7,13 @@ plt.style.use('ggplot')
 plt.ioff()
 import os
 import functools
-from collections import defaultdict
 import numpy as np
 import theano
 import theano.tensor as T
 import lasagne
 from IPython import display
 from tqdm import tqdm
-from data_processing import load_data
+from data_processing import load_proll_data, iterate_composer_windows
 import pdb
 
 # data params
@@ -22,10 +21,13 @@ datapath = '/media/steampunkhd/rafaelvalle/datasets/MIDI/Piano'
 glob_file_str = '*.npy'
 n_pieces = 8  # 0 is equal to all pieces, unbalanced dataset
 crop = None  # (32, 96)
-as_dict = True
+as_dict = False  # ProllCorpus, windows are read from the packed corpus
+cache_dir = datapath + '_cache'  # packed corpus, built on first run
 
 # load data, takes time depending on dataset site
-dataset = load_data(datapath, glob_file_str, n_pieces, crop, as_dict)
+dataset, labels = load_proll_data(datapath, glob_file_str, n_pieces, crop,
+                                  as_dict, cache_dir=cache_dir)
+composers = np.unique(labels)
 
 # model params
 d_batch_size = g_batch_size = 512
@@ -33,8 +35,8 @@ n_timesteps = 100  # 100 ms per step
 min_len = 50
 max_len = 100
 single_len = True
-n_features = dataset[dataset.keys()[0]][0].shape[1]
-n_conditions = len(dataset.keys())
+n_features = dataset.data.shape[0]
+n_conditions = len(composers)
 temperature = 1.
 n_units_d = 8
 n_units_g = 16
@@ -77,10 +79,10 @@ if arch == 1:
 
     # declare generator specs
     g_specs = {'batch_size': g_batch_size,
-               'input_shape': (g_batch_size, max_len, n_features),
-               'noise_shape': (g_batch_size, max_len, int(np.sqrt(n_features)*2)),
-               'cond_shape': (g_batch_size, max_len, n_conditions),
-               'mask_shape': (g_batch_size, max_len),
+               'input_shape': (g_batch_size, None, n_features),
+               'noise_shape': (g_batch_size, None, int(np.sqrt(n_features)*2)),
+               'cond_shape': (g_batch_size, None, n_conditions),
+               'mask_shape': (g_batch_size, None),
                'output_shape':  (g_batch_size, n_timesteps, n_features),
                'n_units': [32, 64, n_features],
                'grad_clip': 100.,
@@ -284,53 +286,14 @@ def build_generator_lstm(params, arch=1):
     return Generator(l_in, l_noise, l_cond, l_mask, l_out)
 
 
-def sample_data(data, batch_size, min_len, max_len, clip=False,
-                single_len=True):
-    encoding = defaultdict(lambda _: 0)
-    i = 0
-    for k in data.keys():
-        encoding[k] = i
-        i += 1
-
-    while True:
-        inputs, conds, masks = [], [], []
-        if single_len:
-            # same length within batch
-            mask_size = np.random.randint(min_len, max_len)
-
-        for composer in np.random.choice(data.keys(), batch_size):
-            piece = np.random.choice(data[composer])
-            start_idx = np.random.randint(0, piece.shape[0] - max_len - 1)
-            piece_data = piece[start_idx: start_idx+max_len]
-            if not single_len:
-                # different lengths within batch
-                mask_size = np.random.randint(min_len, max_len)
-            if clip:
-                piece_data[mask_size:] = 0
-
-            cond = np.zeros((max_len, len(encoding)), dtype=np.float32)
-            cond[:, encoding[k]] = 1
-
-            mask = np.zeros(max_len, dtype=np.int32)
-            mask[:mask_size] = 1
-
-            inputs.append(piece_data)
-            conds.append(cond)
-            masks.append(mask)
-
-        shuffle_ids = np.random.randint(0, len(inputs), len(inputs))
-        inputs = np.array(inputs, dtype=np.float32)[shuffle_ids]
-        conds = np.array(conds, dtype=np.float32)[shuffle_ids]
-        masks = np.array(masks, dtype=np.int32)[shuffle_ids]
-
-        yield inputs, conds, masks
-
-
 def build_training(discriminator, generator, d_specs, g_specs, add_noise=True):
     # Instantiate a symbolic noise generator to use for training
     from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
     srng = RandomStreams(seed=np.random.randint(2147462579, size=6))
-    noise = srng.normal(size=g_specs['noise_shape'], avg=0.0, std=1.0)
+    # time steps follow the batch, which may be trimmed to its longest mask
+    noise = srng.normal(
+        size=(g_in_D.shape[0], g_in_D.shape[1], g_specs['noise_shape'][2]),
+        avg=0.0, std=1.0)
 
     # one-sided label smoothing
     lbl_noise = 0.0
@@ -450,14 +413,15 @@ d_train_fn, g_train_fn, g_sample_fn, d_acc_fn = build_training(
     discriminator, generator, d_specs, g_specs)
 
 print("Create data iterator")
-data_iter = sample_data(dataset, d_batch_size, min_len, max_len,
-                        single_len=single_len)
+data_iter = iterate_composer_windows(dataset, d_batch_size, min_len, max_len,
+                                     single_len=single_len, trim=True,
+                                     n_buckets=8, labels=labels)
 
 # training and pre-training variables
 n_d_iterations_pre = 5
 n_epochs = 1000
 samples_per_composer = 10 * 1800  # 10 pieces, 1800 frames/piece
-epoch_size = int(len(dataset) * samples_per_composer / d_batch_size)
+epoch_size = int(len(composers) * samples_per_composer / d_batch_size)
 n_d_iterations = 1
 n_g_iterations = 1
 
@@ -497,14 +461,15 @@ for i in range(n_d_iterations_pre):
         axes[1].plot(d_acc_g_z, color='red')
         fig.tight_layout()
         fig.savefig('images/{}/pretraining'.format(folderpath))
-        noise = lasagne.utils.floatX(np.random.normal(size=g_specs['noise_shape']))
+        noise = lasagne.utils.floatX(np.random.normal(
+            size=d_X.shape[:2] + (g_specs['noise_shape'][2],)))
         rand_ids = np.random.randint(0, g_specs['noise_shape'][0], 64)
         samples = g_sample_fn(d_X, noise, d_C, d_M)[rand_ids]
 
         plt.imsave('images/{}/pretraining_samples.png'.format(folderpath),
-                   (samples.reshape(8, 8, max_len, n_features)
+                   (samples.reshape(8, 8, -1, n_features)
                            .transpose(0, 2, 1, 3)
-                           .reshape(8*max_len, 8*n_features)).T,
+                           .reshape(-1, 8*n_features)).T,
                    cmap='gray',
                    origin='bottom')
         plt.close('all')
@@ -561,13 +526,14 @@ for epoch in tqdm(range(n_epochs)):
     fig.tight_layout()
     fig.savefig('images/{}/epoch{}'.format(folderpath, epoch))
 
-    noise = lasagne.utils.floatX(np.random.normal(size=g_specs['noise_shape']))
+    noise = lasagne.utils.floatX(np.random.normal(
+        size=d_X.shape[:2] + (g_specs['noise_shape'][2],)))
     rand_ids = np.random.randint(0, g_specs['noise_shape'][0], 64)
     samples = g_sample_fn(d_X, noise, d_C, d_M)[rand_ids]
     plt.imsave('images/{}/epoch{}_samples.png'.format(folderpath, epoch),
-            (samples.reshape(8, 8, max_len, n_features)
+            (samples.reshape(8, 8, -1, n_features)
                     .transpose(0, 2, 1, 3)
-                    .reshape(8*max_len, 8*n_features)).T,
+                    .reshape(-1, 8*n_features)).T,
             cmap='gray',
             origin='bottom')
 
@@ -1,4 +1,5 @@
 import os
+import time
 from datetime import datetime as dt
 from collections import defaultdict
 import numpy as np
@@ -6,97 +7,807 @@ import pandas as pd
 import glob2 as glob
 import pdb
 
-def iterate_minibatches_proll(inputs, labels, batch_size, shuffle=True,
-                              forever=True, length=128):
+class ProllCorpus():
+    """
+    Sequence of piano rolls stored as column ranges of one pitch-major array.
+    Indexing with an int returns a view of that piece, indexing with a slice
+    or an array of ids returns a ProllCorpus over the same data.
+    """
+    def __init__(self, data, starts, lengths):
+        self.data = data
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            start = self.starts[key]
+            return self.data[:, start:start+self.lengths[key]]
+        return ProllCorpus(self.data, self.starts[key], self.lengths[key])
+
+    def ranges(self, starts, lengths):
+        return ProllCorpus(self.data, starts, lengths)
+
+
+class SparseProllCorpus():
+    """
+    Sequence of piano rolls stored frame by frame as CSR arrays: the cells of
+    corpus frame j that differ from their piece's fill value are at
+    pitches[indptr[j]:indptr[j+1]] with values values[indptr[j]:indptr[j+1]].
+    Indexing with an int returns a dense copy of that piece, indexing with a
+    slice or an array of ids returns a SparseProllCorpus over the same data.
+    """
+    def __init__(self, indptr, pitches, values, fills, n_rows, starts,
+                 lengths):
+        self.indptr = indptr
+        self.pitches = pitches
+        self.values = values
+        # value of the empty cells, per item
+        self.fills = np.asarray(fills, dtype=np.float32)
+        self.n_rows = n_rows
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            out = np.empty((1, self.n_rows, self.lengths[key]),
+                           dtype=np.float32)
+            return self.densify([key], [0], self.lengths[key], out)[0]
+        return SparseProllCorpus(
+            self.indptr, self.pitches, self.values, self.fills[key],
+            self.n_rows, self.starts[key], self.lengths[key])
+
+    def ranges(self, starts, lengths, item_ids=None):
+        fills = self.fills if item_ids is None else self.fills[item_ids]
+        return SparseProllCorpus(self.indptr, self.pitches, self.values,
+                                 fills, self.n_rows, starts, lengths)
+
+    def densify(self, piece_ids, starts, length, out):
+        # all nonzero cells of the windows are scattered at once
+        piece_ids = np.asarray(piece_ids)
+        cols = self.starts[piece_ids] + np.asarray(starts, dtype=np.int64)
+        lo, hi = self.indptr[cols], self.indptr[cols + length]
+        counts = hi - lo
+        window = np.repeat(np.arange(len(cols)), counts)
+        cells = (np.arange(counts.sum()) -
+                 np.repeat(np.cumsum(counts) - counts, counts) +
+                 np.repeat(lo, counts))
+        frames = (np.searchsorted(self.indptr, cells, side='right') - 1 -
+                  cols[window])
+        out[:] = self.fills[piece_ids][:, None, None]
+        out[window, self.pitches[cells], frames] = self.values[cells]
+        return out
+
+
+def sparsify_proll_corpus(pieces):
+    """
+    Converts a ProllCorpus or a list of piano rolls into a SparseProllCorpus.
+    The fill of each piece is its minimum, the scaled value of silence.
+    """
+    indptr = [np.zeros(1, dtype=np.int64)]
+    pitches, values, fills, lengths = [], [], [], []
+    n_cells = 0
+    for i in range(len(pieces)):
+        piece = np.asarray(pieces[i])
+        fill = piece.min() if piece.size else -1
+        frames, cur_pitches = np.nonzero(piece.T != fill)
+        counts = np.bincount(frames, minlength=piece.shape[1])
+        indptr.append(np.cumsum(counts) + n_cells)
+        pitches.append(cur_pitches.astype(np.uint8))
+        values.append(piece[cur_pitches, frames].astype(np.float32))
+        fills.append(fill)
+        lengths.append(piece.shape[1])
+        n_cells += len(frames)
+    lengths = np.array(lengths, dtype=np.int64)
+    return SparseProllCorpus(
+        np.concatenate(indptr), np.concatenate(pitches),
+        np.concatenate(values), fills, pieces[0].shape[0],
+        np.cumsum(lengths) - lengths, lengths)
+
+
+class BitProllCorpus():
+    """
+    Sequence of boolean piano rolls stored as bits: frame j of the corpus is
+    np.packbits'ed along pitch into bits[j]. Indexing with an int returns
+    that piece unpacked to -1/1 float32, indexing with a slice or an array of
+    ids returns a BitProllCorpus over the same bits.
+    """
+    def __init__(self, bits, n_rows, starts, lengths):
+        self.bits = bits
+        self.n_rows = n_rows
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            out = np.empty((1, self.n_rows, self.lengths[key]),
+                           dtype=np.float32)
+            return self.densify([key], [0], self.lengths[key], out)[0]
+        return BitProllCorpus(
+            self.bits, self.n_rows, self.starts[key], self.lengths[key])
+
+    def ranges(self, starts, lengths):
+        return BitProllCorpus(self.bits, self.n_rows, starts, lengths)
+
+    def densify(self, piece_ids, starts, length, out):
+        cols = (self.starts[np.asarray(piece_ids)] +
+                np.asarray(starts, dtype=np.int64))
+        frames = self.bits[cols[:, None] + np.arange(length)]
+        cells = np.unpackbits(frames, axis=2)[:, :, :self.n_rows]
+        out[:] = cells.transpose(0, 2, 1)
+        out *= 2
+        out -= 1
+        return out
+
+
+def pack_proll_bits(pieces):
+    """
+    Converts a ProllCorpus or a list of piano rolls into a BitProllCorpus,
+    a cell is set when it is above its piece's minimum, the scaled silence.
+    """
+    bits, lengths = [], []
+    for i in range(len(pieces)):
+        piece = np.asarray(pieces[i])
+        fill = piece.min() if piece.size else 0
+        bits.append(np.packbits(piece.T > fill, axis=1))
+        lengths.append(piece.shape[1])
+    lengths = np.array(lengths, dtype=np.int64)
+    return BitProllCorpus(np.concatenate(bits), pieces[0].shape[0],
+                          np.cumsum(lengths) - lengths, lengths)
+
 
+def proll_lengths(inputs):
+    if isinstance(inputs, (ProllCorpus, SparseProllCorpus, BitProllCorpus)):
+        return inputs.lengths
+    return np.array([x.shape[1] for x in inputs], dtype=np.int64)
+
+
+def sample_proll_windows(inputs, piece_ids, starts, length, out):
+    """
+    Copies the windows [starts, starts+length) of pieces piece_ids into out,
+    shaped (len(piece_ids), n_pitches, length). Windows must lie within
+    their pieces. A ProllCorpus is gathered
+    with a single take over the flat corpus, a SparseProllCorpus or a
+    BitProllCorpus is densified into out.
+    """
+    if isinstance(inputs, (SparseProllCorpus, BitProllCorpus)):
+        inputs.densify(piece_ids, starts, length, out)
+    elif isinstance(inputs, ProllCorpus) and inputs.data.flags.c_contiguous:
+        n_rows, n_cols = inputs.data.shape
+        cols = inputs.starts[piece_ids] + starts
+        idx = (np.arange(n_rows, dtype=np.int64)[:, None] * n_cols +
+               np.arange(length, dtype=np.int64)[None, :])
+        idx = idx[None, :, :] + cols[:, None, None]
+        if out.dtype == inputs.data.dtype:
+            np.take(inputs.data, idx, out=out)
+        else:
+            out[:] = np.take(inputs.data, idx)
+    else:
+        for k in range(len(piece_ids)):
+            out[k] = inputs[piece_ids[k]][:, starts[k]:starts[k]+length]
+    return out
+
+
+def batch_rng(seed, iteration, stream=0):
+    """
+    Random generator of batch iteration of a data stream. It is a pure
+    function of (seed, iteration, stream), so any batch can be reproduced
+    directly and a resumed run replays the batches of the original one.
+    Counter-based Philox when numpy has it, a keyed RandomState otherwise.
+    """
+    seed, iteration, stream = int(seed), int(iteration), int(stream)
+    if hasattr(np.random, 'Philox'):
+        return np.random.Generator(np.random.Philox(
+            key=(seed << 64) | iteration, counter=stream << 128))
+    return np.random.RandomState([seed, iteration, stream])
+
+
+def augment_proll_batch(batch, max_shift=0, max_stretch=1, rng=np.random):
+    """
+    Randomly transposes each (n_pitches, length) roll of batch by up to
+    max_shift rows and stretches it in time by repeating each frame 1 to
+    max_stretch times, with a single gather. Shifts are clipped so no note
+    leaves the rows of the batch, i.e. the crop, and freed rows are filled
+    with the roll's minimum, the scaled silence, as in offset_proll.
+    """
+    n_samples, n_rows, length = batch.shape
+    fills = batch.reshape(n_samples, -1).min(axis=1)
+    active = (batch > fills[:, None, None]).any(axis=2)
+    lowest = np.where(active.any(axis=1), np.argmax(active, axis=1), 0)
+    highest = np.where(active.any(axis=1),
+                       n_rows - 1 - np.argmax(active[:, ::-1], axis=1),
+                       n_rows - 1)
+    shifts = np.clip(rng.choice(2*max_shift + 1, n_samples) - max_shift,
+                     -lowest, n_rows - 1 - highest)
+    stretches = 1 + rng.choice(max_stretch, n_samples)
+
+    rows = np.arange(n_rows)[None, :] - shifts[:, None]
+    frames = np.arange(length)[None, :] // stretches[:, None]
+    out = batch[np.arange(n_samples)[:, None, None],
+                np.clip(rows, 0, n_rows - 1)[:, :, None],
+                frames[:, None, :]]
+    empty = (rows < 0) | (rows >= n_rows)
+    out[empty] = np.repeat(fills, empty.sum(axis=1))[:, None]
+    return out
+
+
+def iterate_minibatches_proll(inputs, labels, batch_size, shuffle=True,
+                              forever=True, length=128, n_buffers=1,
+                              max_shift=0, max_stretch=1, seed=None,
+                              start=0, step=1):
+    # with a seed, batch k is drawn from batch_rng(seed, k) for
+    # k = start, start+step, ... instead of the global np.random
+    rng = np.random
+    iteration = start
+    # pieces batches are drawn from
+    pool = np.arange(len(inputs))
+    if length > 0:
+        lengths = proll_lengths(inputs)
+        # pieces shorter than a window are skipped
+        pool = pool[lengths >= length]
+        if not len(pool):
+            raise Exception("No piece is at least {} frames long".format(
+                length))
+        batches = np.empty((n_buffers, batch_size, inputs[0].shape[0], length),
+                           dtype=np.float32)
+        n_yielded = 0
     while True:
-        indices = np.random.choice(np.arange(len(inputs)), batch_size)
+        if seed is not None:
+            rng = batch_rng(seed, iteration)
+        iteration += step
+        indices = pool[rng.choice(len(pool), batch_size)]
         for start_idx in range(0, len(indices), batch_size):
             if shuffle:
                 excerpt = indices[start_idx:start_idx + batch_size]
             else:
-                excerpt = slice(start_idx, start_idx + batch_size)
+                excerpt = pool[start_idx:start_idx + batch_size]
             if length > 0:
-                data = []
-                # select random slice from each piano roll
-                for i in excerpt:
-                    rand_start = np.random.randint(
-                        0, inputs[i].shape[1] - length)
-                    data.append(inputs[i][:, rand_start:rand_start+length])
+                # select random slice from each piano roll, written in place
+                # so a yielded batch is overwritten n_buffers batches later
+                rand_starts = (rng.uniform(size=len(excerpt)) *
+                               (lengths[excerpt] - length)).astype(np.int64)
+                data = sample_proll_windows(
+                    inputs, excerpt, rand_starts, length,
+                    batches[n_yielded % n_buffers, :len(excerpt)])
+                if max_shift or max_stretch > 1:
+                    data[:] = augment_proll_batch(data, max_shift,
+                                                  max_stretch, rng)
+                n_yielded += 1
             else:
-                data = inputs[excerpt]
-            yield np.array(data).astype(np.float32), labels[excerpt]
+                data = np.array([inputs[i] for i in excerpt]).astype(
+                    np.float32)
+            yield data, labels[excerpt]
 
         if not forever:
             break
 
 
+def iterate_composer_windows(data, batch_size, min_len, max_len, clip=False,
+                             single_len=True, trim=False, n_buckets=1,
+                             labels=None):
+    """
+    Yields (inputs, conds, masks) batches of max_len time-major windows of
+    the pieces in data, either a ProllCorpus with the composer of each
+    piece in labels, read in place so a memory-mapped corpus stays on disk,
+    or a dict of composer to list of time-major pieces, copied into one
+    in-memory corpus. Composers are drawn uniformly, then a piece of that
+    composer, then a start. Everything is drawn for the whole batch at once
+    and windows are gathered with sample_proll_windows. Masks are 1 on the
+    first mask_size steps, drawn in [min_len, max_len) once per batch with
+    single_len, else per window. With n_buckets, windows for that many
+    batches are drawn together and grouped by mask size, and with trim each
+    batch is cut to its longest mask instead of max_len.
+    """
+    if isinstance(data, ProllCorpus):
+        corpus = data
+        labels = np.asarray(labels)
+        composers = list(np.unique(labels))
+        piece_composer = np.searchsorted(composers, labels)
+    else:
+        composers = list(data.keys())
+        pieces = [piece for composer in composers for piece in data[composer]]
+        piece_composer = np.repeat(np.arange(len(composers)),
+                                   [len(data[x]) for x in composers])
+        lengths = np.array([len(piece) for piece in pieces], dtype=np.int64)
+        corpus = ProllCorpus(
+            np.concatenate([piece.T for piece in pieces], axis=1).astype(
+                np.float32), np.cumsum(lengths) - lengths, lengths)
+    # the last valid start is len - max_len - 2, as in the loop it replaces
+    n_starts = corpus.lengths - max_len - 1
+    keep = np.flatnonzero(n_starts > 0)
+    if not len(keep):
+        raise Exception("No piece is longer than {}".format(max_len + 1))
+    # kept pieces grouped by composer, composer i owns pieces
+    # composer_first[i]:composer_first[i]+composer_count[i]
+    keep = keep[np.argsort(piece_composer[keep], kind='mergesort')]
+    n_starts = n_starts[keep]
+    composer_count = np.bincount(piece_composer[keep],
+                                 minlength=len(composers))
+    if (composer_count == 0).any():
+        raise Exception("Composers {} have no piece longer than {}".format(
+            [composers[i] for i in np.where(composer_count == 0)[0]],
+            max_len + 1))
+    composer_first = np.cumsum(composer_count) - composer_count
+    n_features = corpus.data.shape[0]
+    eye = np.eye(len(composers), dtype=np.float32)
+    steps = np.arange(max_len)
+    n_windows = batch_size * n_buckets
+
+    while True:
+        cond_ids = np.random.randint(0, len(composers), n_windows)
+        piece_ids = composer_first[cond_ids] + (
+            np.random.random(n_windows) *
+            composer_count[cond_ids]).astype(np.int64)
+        starts = (np.random.random(n_windows) *
+                  n_starts[piece_ids]).astype(np.int64)
+
+        if single_len:
+            # same length within batch
+            mask_sizes = np.repeat(
+                np.random.randint(min_len, max_len, n_buckets), batch_size)
+        else:
+            mask_sizes = np.random.randint(min_len, max_len, n_windows)
+        # batches are consecutive windows in order of mask size
+        order = np.argsort(mask_sizes, kind='mergesort')
+
+        for bucket in np.random.permutation(n_buckets):
+            ids = order[bucket*batch_size:(bucket+1)*batch_size]
+            cur_steps = steps
+            if trim:
+                cur_steps = steps[:mask_sizes[ids].max()]
+            windows = sample_proll_windows(
+                corpus, keep[piece_ids[ids]], starts[ids], len(cur_steps),
+                np.empty((len(ids), n_features, len(cur_steps)),
+                         dtype=np.float32))
+            inputs = np.ascontiguousarray(windows.transpose(0, 2, 1))
+            masks = (cur_steps[None, :] <
+                     mask_sizes[ids][:, None]).astype(np.int32)
+            if clip:
+                inputs[masks == 0] = 0
+            conds = np.repeat(eye[cond_ids[ids]][:, None, :], len(cur_steps),
+                              axis=1)
+
+            yield inputs, conds, masks
+
+
+class TextCorpus():
+    """
+    Sequence of encoded texts stored as ranges of one code array. Indexing
+    with an int returns a view of that text's codes, indexing with a slice
+    or an array of ids returns a TextCorpus over the same codes.
+    """
+    def __init__(self, codes, starts, lengths):
+        self.codes = codes
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            start = self.starts[key]
+            return self.codes[start:start+self.lengths[key]]
+        return TextCorpus(self.codes, self.starts[key], self.lengths[key])
+
+    def ranges(self, starts, lengths):
+        return TextCorpus(self.codes, starts, lengths)
+
+
+def patch_corpus(corpus, patch_size, patch_stride=None, keep_short=False):
+    """
+    Patches a ProllCorpus or TextCorpus by index only: returns a corpus over
+    the same data whose items are the patch_size long ranges starting every
+    patch_stride steps of each item, and the id of the item of each patch.
+    With keep_short, items shorter than 2*patch_size give a single patch
+    truncated to patch_size, as in patch_text, otherwise they are dropped.
+    """
+    patch_stride = patch_stride or patch_size
+    lengths = corpus.lengths
+    n_patches = np.maximum((lengths - patch_size - 1) // patch_stride, 0)
+    if keep_short:
+        short = lengths < 2*patch_size
+        n_patches[short] = 1
+    item_ids = np.repeat(np.arange(len(corpus)), n_patches)
+    first = np.cumsum(n_patches) - n_patches
+    steps = np.arange(len(item_ids)) - np.repeat(first, n_patches)
+    starts = corpus.starts[item_ids] + steps * patch_stride
+    patch_lengths = np.zeros(len(item_ids), dtype=np.int64) + patch_size
+    if keep_short:
+        patch_lengths = np.where(
+            short[item_ids], np.minimum(lengths[item_ids], patch_size),
+            patch_lengths)
+    if isinstance(corpus, SparseProllCorpus):
+        return corpus.ranges(starts, patch_lengths, item_ids), item_ids
+    return corpus.ranges(starts, patch_lengths), item_ids
+
+
 def iterate_minibatches_text(inputs, labels, batch_size, encoder=None,
                              shuffle=True, forever=True, length=128,
-                             alphabet_size=128, padding=None):
-    from text_utils import binarizeText
+                             alphabet_size=128, padding=None, n_buffers=1,
+                             seed=None, start=0, step=1):
+    # with a seed, batch k is drawn from batch_rng(seed, k) for
+    # k = start, start+step, ... and the order of its epoch from
+    # batch_rng(seed, epoch, stream=1), instead of the global np.random
+    from text_utils import binarizeBatch
 
     if encoder is None:
         raise Exception("Encoder is {}")
-    if shuffle:
-        indices = np.arange(len(inputs))
+    n_epoch_batches = (len(inputs) - batch_size) // batch_size + 1
+    if n_epoch_batches <= 0:
+        raise Exception("Fewer inputs than batch size {}".format(batch_size))
+    indices = np.arange(len(inputs))
+    batches = np.empty((n_buffers, batch_size, alphabet_size, length),
+                       dtype=np.float32)
+    n_yielded = 0
+    rng = np.random
+    iteration, epoch = start, None
     while True:
-        if shuffle:
-            np.random.shuffle(indices)
-        for start_idx in range(0, len(inputs) - batch_size + 1, batch_size):
-            if shuffle:
-                excerpt = indices[start_idx:start_idx + batch_size]
-            else:
-                excerpt = slice(start_idx, start_idx + batch_size)
-
-            data = []
-            # select random slice from each piano roll
-            for i in excerpt:
-                cur_data = binarizeText(
-                    inputs[i], encoder, lower_case=True, remove_html=False)
-                if cur_data.shape[1] < length:
-                    if padding is None:
-                        # ignore examples shorter than length
-                        continue
-                    elif padding == 'zero':
-                        # zero pad data if shorter than length
-                        z = np.zeros((alphabet_size, length))
-                        z[:, :cur_data.shape[1]] = cur_data
-                    elif padding == 'noise':
-                        z = np.zeros((alphabet_size, length))
-                        z[:, :cur_data.shape[1]] = cur_data
-                        z[:, cur_data.shape[1]:] = np.random.normal(
-                            0, 0.0001,
-                            (cur_data.shape[0], length - cur_data.shape[1]))
-                    elif padding == 'repeat':
-                        z = np.zeros((alphabet_size, length))
-                        z[:, :cur_data.shape[1]] = cur_data
-                        # change to vector operation
-                        for k in range(1, length - cur_data.shape[1]-1):
-                            z[:, cur_data.shape[1] + k] = cur_data[
-                                :, (k-1) % cur_data.shape[1]]
-                    else:
-                        raise Exception(
-                            "Padding {} not supported".format(padding))
-                    cur_data = z
-                    data.append(cur_data)
-                elif cur_data.shape[1] > length:
-                    # slice data if larger than length
-                    rand_start = np.random.randint(
-                        0, cur_data.shape[1] - length)
-                    cur_data = cur_data[:, rand_start:rand_start+length]
-                    data.append(cur_data)
-                else:
-                    data.append(cur_data)
-            # scale to [-1, 1]
-            data = np.array(data)
-            data += data.min()
-            data /= data.max()
-            data = (data * 2) - 1
-            yield data.astype(np.float32), labels[excerpt]
+        cur_epoch, start_idx = divmod(iteration, n_epoch_batches)
+        start_idx *= batch_size
+        if cur_epoch != epoch:
+            if epoch is not None and not forever:
+                break
+            epoch = cur_epoch
+            if shuffle and seed is not None:
+                indices = batch_rng(seed, epoch, 1).permutation(len(inputs))
+            elif shuffle:
+                np.random.shuffle(indices)
+        if seed is not None:
+            rng = batch_rng(seed, iteration)
+        iteration += step
 
-        if not forever:
-            break
+        excerpt = indices[start_idx:start_idx + batch_size]
+
+        # one-hot the whole batch in place, scaled to [-1, 1]
+        if isinstance(inputs, TextCorpus):
+            # already encoded, only slice codes
+            codes = inputs.codes
+            starts = inputs.starts[excerpt]
+            lengths = inputs.lengths[excerpt]
+        else:
+            codes, offsets = encoder.encode_batch(
+                [inputs[i].lower() for i in excerpt])
+            starts, lengths = offsets[:-1], np.diff(offsets)
+        data = binarizeBatch(codes, starts, lengths, length,
+                             batches[n_yielded % n_buffers], padding, rng)
+        n_yielded += 1
+        # empty examples, and examples shorter than length without padding,
+        # are ignored
+        excerpt = excerpt[lengths >= (length if padding is None else 1)]
+        yield data, labels[excerpt]
+
+
+def tf_constant_array(session, array):
+    # a device copy of a large array, fed once rather than embedded in the
+    # graph, and kept out of the global variables so savers skip it
+    import tensorflow as tf
+    init = tf.placeholder(tf.as_dtype(array.dtype), shape=array.shape)
+    var = tf.Variable(init, trainable=False, collections=[])
+    session.run(var.initializer, feed_dict={init: array})
+    return var
+
+
+def tf_batch_dataset(session, make_batch, seed, start, n_parallel, prefetch,
+                     steps=None):
+    """
+    Returns the next batch tensor of a tf.data pipeline where
+    make_batch(key) builds batch k in the graph from stateless random ops
+    seeded with key = (seed, k), for k = start, start+1, ... Batches are
+    built by n_parallel map calls and prefetch batches are kept ready. With
+    steps, consecutive batches are stacked steps at a time, for training
+    steps that consume several batches in the graph.
+    """
+    import tensorflow as tf
+    dataset = tf.data.Dataset.range(start, np.iinfo(np.int64).max)
+    dataset = dataset.map(
+        lambda k: make_batch(tf.stack([tf.constant(seed, tf.int64), k])),
+        num_parallel_calls=n_parallel)
+    if steps:
+        dataset = dataset.batch(steps)
+    iterator = dataset.prefetch(prefetch).make_initializable_iterator()
+    session.run(iterator.initializer)
+    return iterator.get_next()
+
+
+def tf_stateless_ops():
+    import tensorflow as tf
+    if hasattr(tf, 'random') and hasattr(tf.random, 'stateless_uniform'):
+        return tf.random.stateless_uniform, tf.random.stateless_normal
+    from tensorflow.contrib.stateless import (
+        stateless_random_uniform, stateless_random_normal)
+    return stateless_random_uniform, stateless_random_normal
+
+
+def proll_input_pipeline(session, inputs, batch_size, length, n_channels=1,
+                         seed=0, start=0, n_parallel=4, prefetch=4,
+                         steps=None):
+    """
+    In-graph version of iterate_minibatches_proll for a ProllCorpus or a
+    BitProllCorpus. The corpus is copied once to the device, batch k draws
+    pieces and starts from (seed, k), and windows are gathered, unpacked to
+    -1/1 and reshaped to (batch_size, n_channels, n_rows, length) inside
+    the graph. As in iterate_minibatches_proll, pieces shorter than length
+    are skipped. Returns the batch tensor, stacked steps at a time if given.
+    """
+    import tensorflow as tf
+    uniform, _ = tf_stateless_ops()
+    if isinstance(inputs, BitProllCorpus):
+        data = tf_constant_array(session, np.asarray(inputs.bits))
+        n_rows = inputs.n_rows
+    elif isinstance(inputs, ProllCorpus):
+        data = tf_constant_array(
+            session, np.asarray(inputs.data, dtype=np.float32))
+        n_rows = inputs.data.shape[0]
+    else:
+        raise Exception("{} not supported".format(type(inputs).__name__))
+    keep = inputs.lengths >= length
+    if not keep.any():
+        raise Exception("No piece is at least {} frames long".format(length))
+    piece_starts = tf.constant(inputs.starts[keep])
+    piece_lengths = tf.constant(inputs.lengths[keep])
+    n_pieces = int(keep.sum())
+
+    def make_batch(key):
+        u = uniform([2, batch_size], seed=key)
+        ids = tf.minimum(tf.cast(u[0] * n_pieces, tf.int64), n_pieces - 1)
+        n_starts = tf.gather(piece_lengths, ids) - length
+        cols = tf.gather(piece_starts, ids) + tf.cast(
+            u[1] * tf.cast(n_starts, tf.float32), tf.int64)
+        cols = cols[:, None] + tf.range(length, dtype=tf.int64)[None, :]
+        if isinstance(inputs, BitProllCorpus):
+            # (batch, length, bytes) -> bits, most significant first
+            frames = tf.gather(data, cols)[:, :, :, None]
+            shifts = tf.constant(np.arange(7, -1, -1, dtype=np.uint8))
+            cells = tf.bitwise.bitwise_and(
+                tf.bitwise.right_shift(frames, shifts), 1)
+            cells = tf.reshape(cells, [batch_size, length, -1])[:, :, :n_rows]
+            batch = tf.cast(tf.transpose(cells, [0, 2, 1]), tf.float32)
+            batch = batch * 2 - 1
+        else:
+            batch = tf.transpose(tf.gather(data, cols, axis=1), [1, 0, 2])
+        return tf.reshape(batch, [batch_size, n_channels, n_rows, length])
+
+    return tf_batch_dataset(session, make_batch, seed, start, n_parallel,
+                            prefetch, steps)
+
+
+def text_input_pipeline(session, inputs, batch_size, length, alphabet_size,
+                        padding=None, n_channels=1, seed=0, start=0,
+                        n_parallel=4, prefetch=4, steps=None):
+    """
+    In-graph version of iterate_minibatches_text for a TextCorpus, one-hot
+    encoding as binarizeBatch does. Texts are drawn uniformly for each
+    batch rather than in epochs, and with padding None only texts of at
+    least length codes are drawn, so every batch is full. Returns the
+    (batch_size, n_channels, alphabet_size, length) batch tensor, stacked
+    steps at a time if given.
+    """
+    import tensorflow as tf
+    uniform, normal = tf_stateless_ops()
+    if padding not in (None, 'zero', 'noise', 'repeat'):
+        raise Exception("Padding {} not supported".format(padding))
+    keep = inputs.lengths >= (length if padding is None else 1)
+    if not keep.any():
+        raise Exception("No text to draw batches from")
+    codes = tf_constant_array(session, np.asarray(inputs.codes))
+    text_starts = tf.constant(inputs.starts[keep])
+    text_lengths = tf.constant(inputs.lengths[keep])
+    n_texts = int(keep.sum())
+    offsets = tf.range(length, dtype=tf.int64)[None, :]
+
+    def make_batch(key):
+        u = uniform([2, batch_size], seed=key)
+        ids = tf.minimum(tf.cast(u[0] * n_texts, tf.int64), n_texts - 1)
+        n = tf.gather(text_lengths, ids)[:, None]
+        # random slice start for texts longer than length
+        slice_starts = tf.cast(
+            u[1][:, None] * tf.cast(tf.maximum(n - length, 0), tf.float32),
+            tf.int64)
+        src = slice_starts + offsets
+        valid = src < n
+        if padding == 'repeat':
+            k = offsets - n
+            repeat = tf.logical_and(k >= 1, k < length - n - 1)
+            src = tf.where(repeat, tf.mod(k - 1, tf.maximum(n, 1)), src)
+            valid = tf.logical_or(valid, repeat)
+        src = tf.minimum(src, n - 1) + tf.gather(text_starts, ids)[:, None]
+        # padded steps get an out of range index, all off in the one-hot
+        symbols = tf.where(valid, tf.cast(tf.gather(codes, src), tf.int64),
+                           tf.fill(tf.shape(src), np.int64(alphabet_size)))
+        batch = tf.one_hot(symbols, alphabet_size, on_value=1.,
+                           off_value=-1., axis=1)
+        if padding == 'noise':
+            noise = normal([batch_size, alphabet_size, length],
+                           seed=key + [0, 1 << 62])
+            padded = tf.cast(offsets >= n, tf.float32)[:, None]
+            batch += noise * 0.0002 * padded
+        return tf.reshape(batch,
+                          [batch_size, n_channels, alphabet_size, length])
+
+    return tf_batch_dataset(session, make_batch, seed, start, n_parallel,
+                            prefetch, steps)
+
+
+def starved_ratio(n_starved, n_batches):
+    return float(n_starved) / max(1, n_batches)
+
+
+class BatchPrefetcher():
+    """
+    Wraps a batch generator and fills a bounded queue of depth batches from
+    n_workers background threads, so batches are built while the training
+    step runs. Starvation, i.e. the consumer finding the queue empty, is
+    counted and timed in stats. Generators that reuse their output buffers,
+    such as the iterate_minibatches_* ones, need
+    n_buffers >= depth + n_workers + 1.
+    """
+    def __init__(self, generator, depth=4, n_workers=1):
+        import threading
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+        self.generator = generator
+        self.queue = queue.Queue(maxsize=depth)
+        self.lock = threading.Lock()
+        self.n_batches = 0
+        self.n_starved = 0
+        self.starved_time = 0.
+        self.done = False
+        self.n_running = n_workers
+        self.workers = []
+        for _ in range(n_workers):
+            worker = threading.Thread(target=self.produce)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def produce(self):
+        while True:
+            try:
+                with self.lock:
+                    batch = next(self.generator)
+            except StopIteration:
+                self.queue.put(StopIteration)
+                return
+            except Exception as e:
+                self.queue.put(e)
+                return
+            self.queue.put(batch)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.done:
+            raise StopIteration
+        if self.queue.empty():
+            self.n_starved += 1
+            start_time = time.time()
+            batch = self.queue.get()
+            self.starved_time += time.time() - start_time
+        else:
+            batch = self.queue.get()
+        if batch is StopIteration:
+            # other workers may still be handing over their last batches
+            self.n_running -= 1
+            self.done = self.n_running == 0
+            return self.next()
+        if isinstance(batch, Exception):
+            self.done = True
+            raise batch
+        self.n_batches += 1
+        return batch
+
+    __next__ = next
+
+    def stats(self):
+        return {'batches': self.n_batches,
+                'starved': self.n_starved,
+                'starved_ratio': starved_ratio(self.n_starved,
+                                               self.n_batches),
+                'starved_time': self.starved_time,
+                'queue_size': self.queue.qsize()}
+
+
+class SharedBatchProducer():
+    """
+    Builds batches in n_workers processes and hands them to the training loop
+    through a ring of n_slots shared memory buffers. make_generator(worker_id)
+    must return a batch generator, each worker seeds np.random with
+    seed + worker_id before calling it. Each worker owns n_slots // n_workers
+    slots and batches are taken from the workers in turn, so a worker that
+    generates batches start+worker_id, start+worker_id+n_workers, ... of a
+    seeded stream yields the stream in order. The returned data is a view
+    into the ring and stays valid until the next batch is requested, labels
+    are passed through a queue.
+    """
+    def __init__(self, make_generator, n_workers=2, n_slots=8, seed=1234):
+        import multiprocessing as mp
+        from multiprocessing.sharedctypes import RawArray
+        n_slots = max(n_slots, n_workers)
+        # probe batch, only used for the buffer shape
+        data, _ = next(make_generator(0))
+        self.shape = data.shape
+        self.ring = RawArray('f', n_slots * int(np.prod(self.shape)))
+        self.batches = np.frombuffer(self.ring, dtype=np.float32).reshape(
+            (n_slots,) + self.shape)
+        self.free_slots = [mp.Queue() for _ in range(n_workers)]
+        self.full_slots = [mp.Queue() for _ in range(n_workers)]
+        for slot in range(n_slots - n_slots % n_workers):
+            self.free_slots[slot % n_workers].put(slot)
+        self.slot = None
+        self.n_batches = 0
+        self.n_starved = 0
+        self.starved_time = 0.
+        self.workers = []
+        for worker_id in range(n_workers):
+            worker = mp.Process(target=self.produce,
+                                args=(make_generator, worker_id, seed))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def produce(self, make_generator, worker_id, seed):
+        np.random.seed(seed + worker_id)
+        generator = make_generator(worker_id)
+        free_slots = self.free_slots[worker_id]
+        full_slots = self.full_slots[worker_id]
+        while True:
+            slot = free_slots.get()
+            try:
+                data, labels = next(generator)
+            except Exception as e:
+                full_slots.put((None, None, e))
+                return
+            self.batches[slot, :len(data)] = data
+            full_slots.put((slot, len(data), labels))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.slot is not None:
+            # the previous batch has been consumed
+            self.free_slots[self.slot % len(self.workers)].put(self.slot)
+            self.slot = None
+        full_slots = self.full_slots[self.n_batches % len(self.workers)]
+        if full_slots.empty():
+            self.n_starved += 1
+            start_time = time.time()
+            slot, n_rows, labels = full_slots.get()
+            self.starved_time += time.time() - start_time
+        else:
+            slot, n_rows, labels = full_slots.get()
+        if slot is None:
+            self.close()
+            raise labels
+        self.slot = slot
+        self.n_batches += 1
+        return self.batches[slot, :n_rows], labels
+
+    __next__ = next
+
+    def stats(self):
+        return {'batches': self.n_batches,
+                'starved': self.n_starved,
+                'starved_ratio': starved_ratio(self.n_starved,
+                                               self.n_batches),
+                'starved_time': self.starved_time,
+                'queue_size': sum(x.qsize() for x in self.full_slots)}
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
 
 
 def create_folder_structure(data_type, loss_type):
@@ -132,96 +843,524 @@ def encode_labels(labels, one_hot=False):
     return labels_enc
 
 
-def load_text_data(datapaths, data_col, label_col, n_pieces, as_dict=True,
-                   patch_size=False, sep=','):
+def patch_text(text, patch_size):
+    if len(text) < 2*patch_size:
+        return [text[:patch_size]]
+    ids = np.arange(0, len(text) - patch_size, patch_size)
+    return [text[ids[k-1]:ids[k]] for k in range(1, len(ids))]
 
-    data = defaultdict(list)
+
+def iterate_text_chunks(datapath, data_col, label_col, n_pieces=0, sep=',',
+                        chunksize=10000):
+    """
+    Streams (texts, labels) from the data_col and label_col columns of a csv
+    file, chunksize rows at a time, reading no other columns. With n_pieces,
+    only n_pieces random rows are kept, which costs an extra counting pass.
+    """
+    cols = sorted(set([data_col, label_col]))
+    if n_pieces:
+        n_rows = sum(len(chunk) for chunk in pd.read_csv(
+            datapath, sep=sep, usecols=[label_col], chunksize=chunksize))
+        rows = np.zeros(n_rows, dtype=bool)
+        rows[np.random.choice(n_rows, n_pieces, replace=False)] = True
+    start = 0
+    for chunk in pd.read_csv(datapath, sep=sep, usecols=cols,
+                             chunksize=chunksize):
+        texts = chunk.iloc[:, cols.index(data_col)].values
+        labels = chunk.iloc[:, cols.index(label_col)].values
+        if n_pieces:
+            keep = rows[start:start+len(chunk)]
+            texts, labels = texts[keep], labels[keep]
+        start += len(chunk)
+        yield texts, labels
+
+
+def iterate_text_patches(datapaths, data_col, label_col, n_pieces,
+                         patch_size=False, sep=',', chunksize=10000):
+    # flat (texts, labels) chunks over all files, patched if patch_size
+    for i in range(len(datapaths)):
+        for texts, labels in iterate_text_chunks(
+                datapaths[i], data_col[i], label_col[i], n_pieces, sep,
+                chunksize):
+            if patch_size:
+                patches = [patch_text(x, patch_size) for x in texts]
+                labels = [l for l, x in zip(labels, patches) for _ in x]
+                texts = [x for patch in patches for x in patch]
+            yield texts, labels
+
+
+def load_text_data(datapaths, data_col, label_col, n_pieces, as_dict=True,
+                   patch_size=False, sep=',', chunksize=10000):
+    # n_pieces, when not 0, keeps n_pieces random texts of each file, before
+    # patching, as load_text_corpus does
     if not as_dict:
         data = []
         labels = []
+        for texts, cur_lbls in iterate_text_patches(
+                datapaths, data_col, label_col, n_pieces, patch_size, sep,
+                chunksize):
+            data.extend(texts)
+            labels.extend(cur_lbls)
+        return np.array(data), np.array(labels)
 
+    data = defaultdict(list)
     for i in range(len(datapaths)):
-        dataset = pd.read_csv(datapaths[i], sep=sep).as_matrix()
-        if n_pieces:
-            dataset = dataset[
-                np.random.choice(np.arange(len(data)), n_pieces, replace=False)]
-        for j in range(len(dataset)):
-            cur_data = dataset[j, data_col[i]]
-            cur_lbl = dataset[j, label_col[i]]
-            if patch_size:
-                if len(cur_data) < 2*patch_size:
-                    cur_data = [cur_data[:patch_size]]
-                else:
-                    ids = np.arange(0, len(cur_data) - patch_size, patch_size)
-                    cur_data = [
-                        cur_data[ids[k-1]:ids[k]] for k in range(1, len(ids))]
-            if not as_dict:
+        for texts, cur_lbls in iterate_text_chunks(
+                datapaths[i], data_col[i], label_col[i], n_pieces, sep,
+                chunksize):
+            for cur_data, cur_lbl in zip(texts, cur_lbls):
                 if patch_size:
-                    for l in range(len(cur_data)):
-                        data.append(cur_data[l])
-                    labels.extend([cur_lbl] * len(cur_data))
-                else:
-                    data.append(cur_data)
-                    labels.extend(cur_lbl)
-            else:
+                    cur_data = patch_text(cur_data, patch_size)
                 data[cur_lbl].append(cur_data)
-    if not as_dict:
-        return np.array(data), np.array(labels)
-
     return data
 
 
+def pack_text_data(files, encoder, corpus_path, lower_case=True):
+    """
+    Encodes the (texts, labels) chunks of each of files and appends the codes
+    to corpus_path.npy, with text i at codes[offsets[i]:offsets[i+1]], so only
+    one chunk of text is held in memory at a time. Offsets, labels and the
+    number of texts of each file are written to corpus_path.idx.npz.
+    """
+    import shutil
+    offsets, labels, file_counts = [np.zeros(1, dtype=np.int64)], [], []
+    n_codes = 0
+    dtype = encoder.encode_table.dtype
+    with open(corpus_path + '.part', 'wb') as f:
+        for chunks in files:
+            file_counts.append(0)
+            for texts, cur_lbls in chunks:
+                if lower_case:
+                    texts = [x.lower() for x in texts]
+                codes, cur_offsets = encoder.encode_batch(texts)
+                codes.astype(dtype).tofile(f)
+                offsets.append(cur_offsets[1:] + n_codes)
+                labels.extend(cur_lbls)
+                n_codes += len(codes)
+                file_counts[-1] += len(texts)
+
+    # prepend the .npy header so the codes can be memory-mapped
+    with open(corpus_path + '.npy', 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': False,
+            'shape': (n_codes,)})
+        with open(corpus_path + '.part', 'rb') as part:
+            shutil.copyfileobj(part, f)
+    os.remove(corpus_path + '.part')
+    np.savez(corpus_path + '.idx.npz', offsets=np.concatenate(offsets),
+             labels=np.array(labels), file_counts=np.array(file_counts))
+
+
+def load_text_corpus(datapaths, data_col, label_col, n_pieces, encoder,
+                     cache_dir, patch_size=False, sep=',', lower_case=True,
+                     patch_stride=None):
+    """
+    Returns a TextCorpus and labels for load_text_data(..., as_dict=False),
+    encoded with encoder. The encoded corpus is cached in cache_dir under a
+    key made of the source files, their mtimes, the loading options and the
+    alphabet, and built on the first call. As in load_text_data, n_pieces,
+    when not 0, keeps n_pieces random texts of each file before patching.
+    Patches are ranges of the cached texts, see patch_corpus.
+    """
+    import hashlib
+    key = repr((
+        [(os.path.abspath(x), os.path.getmtime(x)) for x in datapaths],
+        data_col, label_col, sep, lower_case, list(encoder.alphabet),
+        encoder.out))
+    corpus_path = os.path.join(
+        cache_dir, 'text_' + hashlib.md5(key.encode('utf-8')).hexdigest())
+    # caches written before file_counts was stored are rebuilt
+    if (not os.path.exists(corpus_path + '.idx.npz') or 'file_counts' not in
+            np.load(corpus_path + '.idx.npz').files):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # streamed from the csv files, never fully in memory
+        files = (iterate_text_chunks(datapaths[i], data_col[i], label_col[i],
+                                     0, sep)
+                 for i in range(len(datapaths)))
+        pack_text_data(files, encoder, corpus_path, lower_case)
+
+    codes = np.load(corpus_path + '.npy', mmap_mode='r')
+    index = np.load(corpus_path + '.idx.npz')
+    offsets, labels = index['offsets'], index['labels']
+    ids = np.arange(len(labels))
+    if n_pieces:
+        file_counts = index['file_counts']
+        file_starts = np.cumsum(file_counts) - file_counts
+        ids = np.concatenate([
+            start + np.sort(np.random.choice(count, n_pieces, replace=False))
+            for start, count in zip(file_starts, file_counts)])
+    corpus = TextCorpus(codes, offsets[ids], offsets[ids+1] - offsets[ids])
+    labels = labels[ids]
+    if patch_size:
+        corpus, text_ids = patch_corpus(
+            corpus, patch_size, patch_stride, keep_short=True)
+        labels = labels[text_ids]
+    return corpus, labels
+
+
+def scale_proll(proll, threshold=0):
+    # scale each frame [-1, 1]
+    #proll += proll.min(axis=1)[:, None]
+    #proll /= proll.max(axis=1)[:, None]
+    # global scaling
+    proll += proll.min()
+    proll = proll / float(proll.max())
+    proll = np.nan_to_num(proll)
+    if threshold:
+        proll[proll < threshold] = 0
+        proll[proll >= threshold] = 1
+    return proll * 2 - 1
+
+
+def proll_pitch_counts(proll):
+    # active cells per pitch row, above the piece's minimum, the scaled silence
+    if proll.size == 0:
+        return np.zeros(proll.shape[0], dtype=np.int64)
+    return (proll > proll.min()).sum(axis=1).astype(np.int64)
+
+
+def pitch_range(counts, n_rows=None, coverage=1.0):
+    """
+    Chooses a crop from per pitch row counts of active cells. With n_rows,
+    returns the n_rows wide crop holding the most active cells, otherwise the
+    narrowest crop holding coverage of them, trimming both ends equally.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    if n_rows is not None:
+        n_rows = min(n_rows, len(counts))
+        cumsum = np.concatenate(([0], np.cumsum(counts)))
+        lo = int(np.argmax(cumsum[n_rows:] - cumsum[:-n_rows]))
+        return lo, lo + n_rows
+    active = np.cumsum(counts)
+    if active[-1] == 0:
+        return 0, len(counts)
+    tail = (1 - coverage) * 0.5 * active[-1]
+    lo = int(np.searchsorted(active, tail, side='right'))
+    hi = int(np.searchsorted(active, active[-1] - tail, side='left')) + 1
+    return lo, hi
+
+
+def glob_proll_files(datapath, glob_file_str):
+    filepaths, labels = [], []
+    for folderpath in glob.glob(os.path.join(datapath, '*/')):
+        composer = os.path.basename(os.path.normpath(folderpath))
+        cur_filepaths = glob.glob(os.path.join(
+            os.path.join(datapath, composer), glob_file_str))
+        filepaths.extend(cur_filepaths)
+        labels.extend([composer] * len(cur_filepaths))
+    return filepaths, labels
+
+
+def sources_key(filepaths):
+    # changes whenever a source file is added, removed or modified
+    import hashlib
+    stats = [(os.path.abspath(x), os.path.getmtime(x), os.path.getsize(x))
+             for x in filepaths]
+    return hashlib.md5(repr(sorted(stats)).encode('utf-8')).hexdigest()
+
+
+def proll_cache_path(cache_dir, datapath, glob_file_str):
+    # content addressed by the loader arguments that change the packed data
+    import hashlib
+    key = repr((os.path.abspath(datapath), glob_file_str))
+    return os.path.join(
+        cache_dir, 'proll_' + hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def proll_corpus_stale(corpus_path, datapath, glob_file_str):
+    if not os.path.exists(corpus_path + '.idx.npz'):
+        return True
+    index = np.load(corpus_path + '.idx.npz')
+    if 'sources_key' not in index or 'pitch_counts' not in index:
+        return True
+    if 'scale' in index:
+        # packed scaled by an older version, scaling is now done on read
+        return True
+    filepaths, _ = glob_proll_files(datapath, glob_file_str)
+    return str(index['sources_key']) != sources_key(filepaths)
+
+
+def pack_proll_data(datapath, glob_file_str, corpus_path, dtype=np.float32):
+    """
+    Packs every piano roll matching glob_file_str under datapath into a single
+    pitch-major memory-mapped array, corpus_path.npy, where piece i occupies
+    columns offsets[i]:offsets[i+1]. Rolls are stored unscaled, they are
+    cropped and then scaled on read, see derived_proll_corpus. Offsets,
+    composer labels, source paths, a key of the source files and active
+    cells per pitch of each piece are written to corpus_path.idx.npz.
+    """
+    filepaths, labels = glob_proll_files(datapath, glob_file_str)
+    if len(filepaths) == 0:
+        raise Exception("No files matching {} in {}".format(
+            glob_file_str, datapath))
+    if any(x.lower().endswith(('.mid', '.midi')) for x in filepaths):
+        # MIDI corpora are rendered by midi2npyproll, which has the
+        # rendering options
+        raise Exception(
+            "Corpus {} is missing or stale and {} matches MIDI files, "
+            "rerun midi2npyproll.py {} --datapath {} --pack {}".format(
+                corpus_path, glob_file_str, glob_file_str, datapath,
+                corpus_path))
+
+    # headers only, the data is read once when filling the corpus
+    shapes = [np.load(filepath, mmap_mode='r').shape for filepath in filepaths]
+    n_rows = shapes[0][0]
+    offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([shape[1] for shape in shapes])
+
+    corpus = np.lib.format.open_memmap(
+        corpus_path + '.npy', mode='w+', dtype=dtype,
+        shape=(n_rows, int(offsets[-1])))
+    pitch_counts = np.zeros((len(filepaths), n_rows), dtype=np.int64)
+    for i, filepath in enumerate(filepaths):
+        cur_data = np.load(filepath)
+        if cur_data.shape[0] != n_rows:
+            raise Exception("{} has {} rows, expected {}".format(
+                filepath, cur_data.shape[0], n_rows))
+        corpus[:, offsets[i]:offsets[i+1]] = cur_data
+        # from the stored values, as the unpacked path counts them
+        pitch_counts[i] = proll_pitch_counts(
+            corpus[:, offsets[i]:offsets[i+1]])
+    corpus.flush()
+    del corpus
+
+    np.savez(corpus_path + '.idx.npz', offsets=offsets,
+             labels=np.array(labels), filepaths=np.array(filepaths),
+             sources_key=sources_key(filepaths), pitch_counts=pitch_counts)
+
+
+def open_proll_corpus(corpus_path):
+    """
+    Opens a corpus written by pack_proll_data. Returns the read-only
+    memory-mapped data and its index, nothing is read from disk until sliced.
+    """
+    corpus = np.load(corpus_path + '.npy', mmap_mode='r')
+    index = dict(np.load(corpus_path + '.idx.npz'))
+    return corpus, index
+
+
+def choose_crop(crop, counts):
+    # crop is None, a (lo, hi) range, 'auto' for the range of pitches used
+    # or an int for the densest range of that many pitches
+    if crop is None or isinstance(crop, (tuple, list)):
+        return crop
+    if crop == 'auto':
+        crop = pitch_range(counts)
+    else:
+        crop = pitch_range(counts, n_rows=int(crop))
+    print("Pitch crop {} holds {} of {} active cells".format(
+        crop, counts[crop[0]:crop[1]].sum(), counts.sum()))
+    return crop
+
+
+def load_raw_proll(proll, crop=None, scale=True, threshold=0):
+    # a roll as the loaders return it: cast to float32, cropped, then scaled
+    if crop is not None:
+        proll = proll[crop[0]:crop[1]]
+    proll = np.array(proll, dtype=np.float32)
+    if scale:
+        proll = scale_proll(proll, threshold)
+    return proll
+
+
+def derived_proll_path(corpus_path, index, crop, scale, threshold, kind):
+    # keyed by the packed sources too, so a repack invalidates it
+    import hashlib
+    key = repr((str(index['sources_key']), crop and tuple(map(int, crop)),
+                bool(scale), float(threshold) if scale else 0., kind))
+    return '{}.{}_{}'.format(corpus_path, kind,
+                             hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+class ScaledProllPieces():
+    """
+    Pieces of an unscaled ProllCorpus, cast and scaled by load_raw_proll as
+    they are indexed, so derived corpora are built one piece at a time.
+    """
+    def __init__(self, pieces, scale=True, threshold=0):
+        self.pieces = pieces
+        self.scale = scale
+        self.threshold = threshold
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __getitem__(self, key):
+        return load_raw_proll(self.pieces[key], None, self.scale,
+                              self.threshold)
+
+
+def derived_proll_corpus(corpus_path, crop=None, scale=True, threshold=0,
+                         kind='dense'):
+    """
+    Returns all pieces of the packed corpus at corpus_path, cropped and then
+    scaled piece by piece as load_raw_proll does, as a ProllCorpus with kind
+    'dense', a SparseProllCorpus with kind 'sparse' or a BitProllCorpus with
+    kind 'bits'. Unscaled dense rows
+    are memory-mapped views of the corpus, anything else is built once, one
+    piece in memory at a time, and stored next to the corpus, keyed by
+    crop, scale, threshold and kind.
+    """
+    corpus, index = open_proll_corpus(corpus_path)
+    offsets = index['offsets']
+    starts, lengths = offsets[:-1], offsets[1:] - offsets[:-1]
+    if crop is not None:
+        # pitch-major rows, only the cropped ones are ever read from disk
+        corpus = corpus[crop[0]:crop[1]]
+    raw = ProllCorpus(corpus, starts, lengths)
+    if kind == 'dense' and not scale:
+        return raw
+    pieces = ScaledProllPieces(raw, scale, threshold)
+    path = derived_proll_path(corpus_path, index, crop, scale, threshold,
+                              kind)
+    if kind == 'dense':
+        path += '.npy'
+        if not os.path.exists(path):
+            part = np.lib.format.open_memmap(
+                path + '.part', mode='w+', dtype=np.float32,
+                shape=corpus.shape)
+            for i in range(len(pieces)):
+                part[:, starts[i]:starts[i]+lengths[i]] = pieces[i]
+            part.flush()
+            del part
+            os.rename(path + '.part', path)
+        return ProllCorpus(np.load(path, mmap_mode='r'), starts, lengths)
+    elif kind == 'sparse':
+        path += '.npz'
+        if not os.path.exists(path):
+            sparse = sparsify_proll_corpus(pieces)
+            np.savez(path[:-4] + '.part.npz', indptr=sparse.indptr,
+                     pitches=sparse.pitches, values=sparse.values,
+                     fills=sparse.fills)
+            os.rename(path[:-4] + '.part.npz', path)
+        arrays = np.load(path)
+        return SparseProllCorpus(
+            arrays['indptr'], arrays['pitches'], arrays['values'],
+            arrays['fills'], corpus.shape[0], starts, lengths)
+    elif kind == 'bits':
+        path += '.npy'
+        if not os.path.exists(path):
+            with open(path + '.part', 'wb') as f:
+                np.save(f, pack_proll_bits(pieces).bits)
+            os.rename(path + '.part', path)
+        return BitProllCorpus(np.load(path, mmap_mode='r'), corpus.shape[0],
+                              starts, lengths)
+    raise Exception("Corpus kind {} not supported".format(kind))
+
+
+def load_proll_corpus(corpus_path, n_pieces, crop=None, scale=True,
+                      threshold=0, kind='dense'):
+    _, index = open_proll_corpus(corpus_path)
+    labels = index['labels']
+    ids = np.arange(len(labels))
+    if n_pieces:
+        ids = np.concatenate([
+            np.random.choice(ids[labels == composer], n_pieces, replace=False)
+            for composer in np.unique(labels)])
+    crop = choose_crop(crop, index['pitch_counts'][ids].sum(axis=0))
+    pieces = derived_proll_corpus(corpus_path, crop, scale, threshold,
+                                  kind)[ids]
+    return pieces, [str(l) for l in labels[ids]]
+
+
 def load_proll_data(datapath, glob_file_str, n_pieces, crop=None, as_dict=True,
-                    scale=True, patch_size=False, threshold=0):
+                    scale=True, patch_size=False, threshold=0,
+                    corpus_path=None, patch_stride=None, cache_dir=None,
+                    sparse=False, bits=False):
+    # bits keeps boolean rolls packed, it takes precedence over sparse
 
     data = defaultdict(list)
     if not as_dict:
         data = []
         labels = []
-    for folderpath in glob.glob(os.path.join(datapath, '*/')):
-        composer = os.path.basename(os.path.normpath(folderpath))
-        filepaths = glob.glob(os.path.join(
-            os.path.join(datapath, composer), glob_file_str))
-        if n_pieces:
-            filepaths = np.random.choice(filepaths, n_pieces, replace=False)
-        for filepath in filepaths:
-            cur_data = np.load(filepath)
-            if crop is not None:
-                cur_data = cur_data[crop[0]:crop[1], :]
-            if scale:
-                # scale each frame [-1, 1]
-                #cur_data += cur_data.min(axis=1)[:, None]
-                #cur_data /= cur_data.max(axis=1)[:, None]
-                # global scaling
-                cur_data += cur_data.min()
-                cur_data = cur_data / float(cur_data.max())
-                cur_data = np.nan_to_num(cur_data)
-                if threshold:
-                    cur_data[cur_data < threshold] = 0
-                    cur_data[cur_data >= threshold] = 1
-                cur_data = cur_data * 2 - 1
+    if corpus_path is None and cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        corpus_path = proll_cache_path(cache_dir, datapath, glob_file_str)
+    if corpus_path is not None:
+        # (re)packed when missing or when the source files changed
+        if proll_corpus_stale(corpus_path, datapath, glob_file_str):
+            pack_proll_data(datapath, glob_file_str, corpus_path)
+        # bit-packed and sparse corpora are stored next to the packed one
+        kind = 'dense'
+        if not as_dict:
+            kind = 'bits' if bits else 'sparse' if sparse else 'dense'
+        pieces, composers = load_proll_corpus(
+            corpus_path, n_pieces, crop, scale, threshold, kind)
+        if not as_dict:
             if patch_size:
-                ids = np.arange(0, cur_data.shape[1] - patch_size, patch_size)
-                cur_data = np.array([
-                    cur_data[:, ids[i-1]:ids[i]] for i in range(1, len(ids))])
-            if not as_dict:
-                if patch_size:
-                    data.extend(cur_data)
-                    labels.extend([composer] * len(cur_data))
-                else:
-                    data.append(cur_data)
-                    labels.append(composer)
+                # patches are ranges of the corpus, see patch_corpus
+                pieces, piece_ids = patch_corpus(
+                    pieces, patch_size, patch_stride)
+                composers = np.array(composers)[piece_ids]
+            return pieces, np.array(composers)
+    else:
+        filepaths, composers = [], []
+        for folderpath in glob.glob(os.path.join(datapath, '*/')):
+            composer = os.path.basename(os.path.normpath(folderpath))
+            cur_filepaths = glob.glob(os.path.join(
+                os.path.join(datapath, composer), glob_file_str))
+            if n_pieces:
+                cur_filepaths = np.random.choice(
+                    cur_filepaths, n_pieces, replace=False)
+            filepaths.extend(cur_filepaths)
+            composers.extend([composer] * len(cur_filepaths))
+        # pitch-major files, only the cropped rows are read
+        rolls = [np.load(filepath, mmap_mode='r') for filepath in filepaths]
+        if crop is not None and not isinstance(crop, (tuple, list)):
+            # each file is read once, counted unscaled as packing does and
+            # kept until the crop is known
+            rolls = [np.asarray(roll, dtype=np.float32) for roll in rolls]
+            crop = choose_crop(crop, sum(proll_pitch_counts(roll)
+                                         for roll in rolls))
+        pieces = [load_raw_proll(roll, crop, scale, threshold)
+                  for roll in rolls]
+        del rolls
+        if not as_dict and (patch_size or sparse or bits) and len(pieces):
+            # one in-memory corpus, patches are ranges of it
+            if bits:
+                pieces = pack_proll_bits(pieces)
+            elif sparse:
+                pieces = sparsify_proll_corpus(pieces)
             else:
-                data[composer].append(cur_data)
-    if not as_dict:
+                lengths = proll_lengths(pieces)
+                pieces = ProllCorpus(np.concatenate(pieces, axis=1),
+                                     np.cumsum(lengths) - lengths, lengths)
+            piece_ids = np.arange(len(pieces))
+            if patch_size:
+                pieces, piece_ids = patch_corpus(
+                    pieces, patch_size, patch_stride)
+            return pieces, np.array(composers)[piece_ids]
+
+    for cur_data, composer in zip(pieces, composers):
         if patch_size:
-            return np.array(data), np.array(labels)
+            ids = np.arange(0, cur_data.shape[1] - patch_size, patch_size)
+            cur_data = np.array([
+                cur_data[:, ids[i-1]:ids[i]] for i in range(1, len(ids))])
+        if not as_dict:
+            data.append(cur_data)
+            labels.append(composer)
         else:
-            return data, np.array(labels)
+            data[composer].append(cur_data)
+    if not as_dict:
+        return data, np.array(labels)
 
     return data
 
 
+def load_data(datapath, glob_file_str, n_pieces, crop=None, as_dict=True,
+              corpus_path=None, cache_dir=None):
+    # time-major (frames, pitches) views as used by the recurrent models
+    data = load_proll_data(datapath, glob_file_str, n_pieces, crop, as_dict,
+                           corpus_path=corpus_path, cache_dir=cache_dir)
+    if as_dict:
+        return dict((k, [piece.T for piece in v]) for k, v in data.items())
+    data, labels = data
+    return [piece.T for piece in data], labels
+
+
 def postprocess_proll(proll, threshold, argmax, boolean):
     if threshold < proll.max():
         proll[proll < threshold] = -1
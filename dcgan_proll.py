@@ -167,7 +167,9 @@ def main(num_epochs=200, convs=0, batchsize=64, initial_eta=5e-3, add_noise=True
     n_pieces = 0  # 0 is equal to all pieces, unbalanced dataset
     crop = None  # (32, 96)
     as_dict = False
-    inputs, _ = load_data(datapath, glob_file_str, n_pieces, crop, as_dict)
+    cache_dir = datapath + '_cache'  # packed corpus, built on first run
+    inputs, _ = load_data(datapath, glob_file_str, n_pieces, crop, as_dict,
+                          cache_dir=cache_dir)
 
     # scale to [0, 1]
     # inputs = (inputs + 1) * 0.5
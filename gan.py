@@ -20,6 +20,9 @@ from tqdm import tqdm
 import time
 import sys
 import argparse
+import functools
+import multiprocessing as mp
+from collections import OrderedDict
 import cPickle as pkl
 
 import numpy as np
@@ -30,24 +33,49 @@ import lasagne
 
 from models import build_generator, build_generator_lstm, build_critic
 from data_processing import (
-    load_proll_data, load_text_data, encode_labels, create_folder_structure,
-    iterate_minibatches_proll, iterate_minibatches_text)
+    load_proll_data, load_text_corpus, encode_labels, create_folder_structure,
+    iterate_minibatches_proll, iterate_minibatches_text, BatchPrefetcher,
+    SharedBatchProducer)
+from nnet_utils import (
+    ProcessBarrier, ParameterAverager, split_threads, time_steps)
 from text_utils import textEncoder
 import pdb
 
 
 
+def stack_batches(batches, n, block=None):
+    """
+    Copies the next n (inputs, conditions) batches into a block of
+    (n, batch, 1, H, W) inputs and (n, batch, n_conditions) conditions,
+    reusing block when it holds n batches. Batches are copied as they
+    arrive since the iterators reuse their output buffers.
+    """
+    for i in range(n):
+        batch_in, batch_cond = next(batches)
+        if block is None or len(block[0]) != n:
+            block = (np.empty((n, batch_in.shape[0], 1) + batch_in.shape[1:],
+                              dtype=np.float32),
+                     np.empty((n,) + batch_cond.shape, dtype=np.float32))
+        block[0][i, :, 0] = batch_in
+        block[1][i] = batch_cond
+    return block
+
+
 def build_functions(critic, generator, clip, batch_size, input_var, noise_var,
                     cond_var, c_eta, g_eta, noise_size, loss_type, lambd,
-                    build_grads=False, n_steps=None, g_arch=None):
+                    build_grads=False, n_steps=None, g_arch=None,
+                    build_scan=False, srng=None):
 
     # instantiate a symbolic noise generator to use in training
-    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
-    srng = RandomStreams(seed=np.random.randint(2147462579, size=6))
-    if g_arch.startswith("lstm"):
-        noise = srng.normal((batch_size, n_steps, noise_size))
-    else:
-        noise = srng.normal((batch_size, noise_size))
+    if srng is None:
+        from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+        srng = RandomStreams(seed=np.random.randint(2147462579, size=6))
+
+    def sample_noise():
+        if g_arch.startswith("lstm"):
+            return srng.normal((batch_size, n_steps, noise_size))
+        return srng.normal((batch_size, noise_size))
+    noise = sample_noise()
     if loss_type == 'iwgan':
         alpha = srng.uniform((batch_size, 1, 1, 1), low=0., high=1.)
 
@@ -141,6 +169,39 @@ def build_functions(critic, generator, clip, batch_size, input_var, noise_var,
         givens={noise_var: noise},
         updates=critic_updates)
 
+    # k critic updates on a (k, batch, 1, H, W) block of real batches in one
+    # scan, with k the length of the block
+    if build_scan:
+        input_block = T.TensorType('float32', (False,) * 5)('input_block')
+        if cond_var:
+            cri_block_input = [input_block, T.ftensor3('condition_block')]
+        else:
+            cri_block_input = [input_block]
+        critic_update_params = list(critic_updates.keys())
+
+        def critic_step(*step_input):
+            # noise is drawn inside the step, an outer draw would be reused
+            replace = dict(zip(cri_input, step_input))
+            replace[noise_var] = sample_noise()
+            if loss_type == 'iwgan':
+                replace[alpha] = srng.uniform(
+                    (batch_size, 1, 1, 1), low=0., high=1.)
+            step_out = theano.clone(
+                [critic_score, critic_penalty] +
+                [critic_updates[p] for p in critic_update_params],
+                replace=replace)
+            return step_out[:2], OrderedDict(
+                zip(critic_update_params, step_out[2:]))
+
+        (block_scores, block_penalties), block_updates = theano.scan(
+            critic_step, sequences=cri_block_input)
+        critic_block_train_fn = theano.function(
+            cri_block_input,
+            [block_scores, block_penalties],
+            updates=block_updates)
+    else:
+        critic_block_train_fn = None
+
     # compile another function generating some data
     gen_fn = theano.function(
         samp_input, lasagne.layers.get_output(generator, deterministic=True))
@@ -160,13 +221,14 @@ def build_functions(critic, generator, clip, batch_size, input_var, noise_var,
         generator_grad_fn = None
 
     return (generator_train_fn, critic_train_fn, gen_fn, critic_grad_fn,
-            generator_grad_fn)
+            generator_grad_fn, critic_block_train_fn)
 
 
 def main(data_type, c_arch, g_arch, num_epochs, epoch_size, batch_size,
          c_initial_eta, g_initial_eta, clip, noise_size, boolean, conditional,
          c_batch_norm, g_batch_norm, c_iters, cl_iters, loss_type, cl_freq,
-         weight_decay, save_model_every, trial_path, lambd):
+         weight_decay, save_model_every, trial_path, lambd, prefetch=4,
+         workers=0, scan_critic=0, n_procs=1, baseline=0):
     # Load the data according to datatype
     print("Loading data...")
     if data_type == 'text':
@@ -180,13 +242,15 @@ def main(data_type, c_arch, g_arch, num_epochs, epoch_size, batch_size,
         as_dict = False
         n_steps = 128
         padding = 'repeat'
-        inputs, labels = load_text_data(
-            datapaths, data_cols, label_cols, n_pieces, as_dict,
-            patch_size=n_steps)
+        cache_dir = '/media/steampunkhd/rafaelvalle/datasets/TEXT/cache'
         iterator = iterate_minibatches_text
         # alphabet = list("abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+ =<>()[]{}")
         alphabet = [chr(x) for x in range(127)]
         encoder = textEncoder(alphabet)
+        # encoded once and cached, batches only slice codes
+        inputs, labels = load_text_corpus(
+            datapaths, data_cols, label_cols, n_pieces, encoder, cache_dir,
+            patch_size=n_steps)
         alphabet_size = len(encoder.alphabet) + 1
         pkl.dump(encoder, open("encdec.pkl", "wb"))
         i_len = 128
@@ -200,15 +264,10 @@ def main(data_type, c_arch, g_arch, num_epochs, epoch_size, batch_size,
         n_steps = 128
         i_len = 128
         patch_size = False
+        # boolean rolls stay bit-packed, batches are unpacked to [-1, 1]
         inputs, labels = load_proll_data(
             datapath, glob_file_str, n_pieces, crop, as_dict,
-            patch_size=patch_size)
-        if boolean:
-            inputs += inputs.min()
-            inputs /= inputs.max()
-            inputs = inputs.astype(bool)
-            # project to [-1, 1]
-            inputs = lasagne.utils.floatX((inputs * 2) - 1)
+            patch_size=patch_size, bits=bool(boolean))
         iterator = iterate_minibatches_proll
     else:
         raise Exception("Datatype {} not supported".format(data_type))
@@ -266,115 +325,235 @@ def main(data_type, c_arch, g_arch, num_epochs, epoch_size, batch_size,
     pkl.dump(generator,
              open("{}/models/generator_blank.pkl".format(trial_path), "wb"))
 
-    # Build train and sampling functions
-    g_train_fn, c_train_fn, g_gen_fn, c_grad_fn, g_grad_fn = build_functions(
-        critic, generator, clip, batch_size, input_var, noise_var, cond_var,
+    # Build train and sampling functions, on a shard of each batch when
+    # training data parallel
+    if batch_size % n_procs:
+        raise Exception("Batch size {} not divisible by {} processes".format(
+            batch_size, n_procs))
+    shard_size = batch_size // n_procs
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+    srng = RandomStreams(seed=np.random.randint(2147462579, size=6))
+    (g_train_fn, c_train_fn, g_gen_fn, c_grad_fn, g_grad_fn,
+     c_block_train_fn) = build_functions(
+        critic, generator, clip, shard_size, input_var, noise_var, cond_var,
         c_eta, g_eta, noise_size, loss_type, lambd, n_steps=n_steps,
-        g_arch=g_arch)
+        g_arch=g_arch, build_scan=bool(scan_critic), srng=srng)
+
+    if not epoch_size:
+        epoch_size = len(inputs) / batch_size
 
     # Create an infinite supply of batches (as an iterable generator)
     if data_type == 'text':
-        batches = iterator(
-            inputs, labels, batch_size, encoder, shuffle=True, length=i_len,
-            forever=True, alphabet_size=alphabet_size, padding=padding)
+        batch_iterator = functools.partial(
+            iterator, inputs, labels, shard_size, encoder, shuffle=True,
+            length=i_len, forever=True, alphabet_size=alphabet_size,
+            padding=padding, n_buffers=prefetch + 2)
     elif data_type == 'proll':
-        batches = iterator(
-            inputs, labels, batch_size, shuffle=True, length=i_len,
-            forever=True)
-
-    # set variables for storing scores
-    if not epoch_size:
-        epoch_size = len(inputs) / batch_size
-    generator_iterations = 0
-    epoch_critic_scores = np.zeros((num_epochs, 2))
-    epoch_generator_scores = np.zeros((num_epochs, 2))
-
-    print("Starting training...")
-    for epoch in range(1, num_epochs+1):
-        start_time = time.time()
-        critic_scores = []
-        generator_scores = []
-        for _ in tqdm(range(epoch_size)):
-            if (generator_iterations < 25) or (generator_iterations % cl_freq) == 0:
-                critic_runs = cl_iters
-            else:
-                critic_runs = c_iters
-            for _ in range(critic_runs):
-                batch_in, batch_cond = next(batches)
-                # reshape batch to proper dimensions
-                batch_in = batch_in.reshape(
-                    (batch_in.shape[0], 1, batch_in.shape[1], batch_in.shape[2]))
+        batch_iterator = functools.partial(
+            iterator, inputs, labels, shard_size, shuffle=True, length=i_len,
+            forever=True, n_buffers=prefetch + 2)
+
+    if n_procs > 1 and not baseline:
+        # the baseline is one process training the n_procs shards of a step
+        # one after another with all cores, timed before the threads are
+        # split and with the parameters restored afterwards
+        random_state = np.random.get_state()
+        batch_in, batch_cond = [np.array(x) for x in next(batch_iterator())]
+        np.random.set_state(random_state)
+        batch_in = batch_in.reshape(
+            (batch_in.shape[0], 1, batch_in.shape[1], batch_in.shape[2]))
+        c_args = (batch_in, batch_cond) if cond_var else (batch_in,)
+        g_args = (batch_cond,) if cond_var else ()
+
+        def step():
+            for _ in range(n_procs):
+                c_train_fn(*c_args)
+                g_train_fn(*g_args)
+        baseline = 2 * batch_size / time_steps(
+            [c_train_fn, g_train_fn], step, n_steps=5)
+        print("Baseline {:.1f} samples/s on one process".format(baseline))
+
+    if n_procs > 1:
+        # each process takes its own optimizer step on its shard and the
+        # parameters, not the gradients, are averaged across processes after
+        # every update, optimizer state stays local. The first process logs
+        # and saves
+        barrier = ProcessBarrier(n_procs)
+        critic_averager = ParameterAverager(
+            lasagne.layers.get_all_params(critic), n_procs, barrier)
+        generator_averager = ParameterAverager(
+            lasagne.layers.get_all_params(generator), n_procs, barrier)
+        averagers = [critic_averager, generator_averager]
+        n_threads = split_threads(n_procs)
+        print("Data parallel {} processes, {} threads each".format(
+            n_procs, n_threads))
+    else:
+        averagers = []
+
+    def train(rank):
+        if rank:
+            # each process draws its own batches and noise
+            np.random.seed(1234 + rank)
+            srng.seed(1234 + rank)
+        if workers:
+            # build batches in worker processes, handed over in shared memory
+            batches = SharedBatchProducer(
+                lambda worker_id: batch_iterator(), n_workers=workers,
+                n_slots=prefetch + workers + 1, seed=1234 + rank * workers)
+        elif prefetch:
+            # build batches in the background while theano runs
+            batches = BatchPrefetcher(batch_iterator(), depth=prefetch)
+        else:
+            batches = batch_iterator()
+
+        # set variables for storing scores
+        generator_iterations = 0
+        epoch_critic_scores = np.zeros((num_epochs, 2))
+        epoch_generator_scores = np.zeros((num_epochs, 2))
+        # stacked real batches for the scan critic, one per number of runs
+        blocks = {}
+
+        if not rank:
+            print("Starting training...")
+        for epoch in range(1, num_epochs+1):
+            start_time = time.time()
+            sync_time = sum(x.sync_time for x in averagers)
+            critic_scores = []
+            generator_scores = []
+            n_epoch_samples = 0
+            for _ in tqdm(range(epoch_size), disable=bool(rank)):
+                if (generator_iterations < 25) or (generator_iterations % cl_freq) == 0:
+                    critic_runs = cl_iters
+                else:
+                    critic_runs = c_iters
+                if scan_critic:
+                    blocks[critic_runs] = stack_batches(
+                        batches, critic_runs, blocks.get(critic_runs))
+                    block_in, block_cond = blocks[critic_runs]
+                    if cond_var:
+                        block_scores = c_block_train_fn(block_in, block_cond)
+                    else:
+                        block_scores = c_block_train_fn(block_in)
+                    critic_scores.extend(np.transpose(block_scores))
+                    batch_cond = block_cond[-1]
+                    if averagers:
+                        critic_averager.average(rank)
+                for _ in range(0 if scan_critic else critic_runs):
+                    batch_in, batch_cond = next(batches)
+                    # reshape batch to proper dimensions
+                    batch_in = batch_in.reshape(
+                        (batch_in.shape[0], 1, batch_in.shape[1], batch_in.shape[2]))
+                    if cond_var:
+                        critic_scores.append(c_train_fn(batch_in, batch_cond))
+                    else:
+                        critic_scores.append(c_train_fn(batch_in))
+                    if averagers:
+                        critic_averager.average(rank)
                 if cond_var:
-                    critic_scores.append(c_train_fn(batch_in, batch_cond))
+                    generator_scores.append(g_train_fn(batch_cond))
                 else:
-                    critic_scores.append(c_train_fn(batch_in))
+                    generator_scores.append(g_train_fn())
+                if averagers:
+                    generator_averager.average(rank)
+                generator_iterations += 1
+                n_epoch_samples += (critic_runs + 1) * batch_size
+
+            # After half the epochs, we start decaying the learn rate towards zero
+            if weight_decay:
+                if epoch >= num_epochs // 2:
+                    progress = float(epoch) / num_epochs
+                    c_eta.set_value(lasagne.utils.floatX(
+                        c_initial_eta*2*(1 - progress)))
+                    g_eta.set_value(lasagne.utils.floatX(
+                        g_initial_eta*2*(1 - progress)))
+
+            # only the first process reports, the others hold the same params
+            if rank:
+                continue
+
+            # add results to history
+            epoch_critic_scores[epoch-1] = np.mean(critic_scores, axis=0)
+            epoch_generator_scores[epoch-1] = np.mean(generator_scores, axis=0)
+            # Then we print the results for this epoch:
+            print("""Epoch {} of {} took {:.3f}s\t
+                  Critic Loss {} \n\t\tGenerator Loss {}""".format(
+                  epoch + 1, num_epochs, time.time() - start_time,
+                  epoch_critic_scores[epoch-1], epoch_generator_scores[epoch-1]))
+            if workers or prefetch:
+                print("Prefetch {}".format(batches.stats()))
+            # scaling efficiency is throughput over n_procs times the
+            # samples/s of one process
+            elapsed = time.time() - start_time
+            rate = n_epoch_samples / elapsed
+            print("Throughput {:.1f} samples/s".format(rate))
+            if averagers:
+                sync_time = sum(x.sync_time for x in averagers) - sync_time
+                print("Data parallel {} processes: {:.3f} of the time "
+                      "averaging".format(n_procs, sync_time / elapsed))
+                print("Scaling efficiency {:.3f} over {:.1f} samples/s "
+                      "baseline".format(rate / (n_procs * baseline),
+                                        baseline))
+
+            fig, axes = plt.subplots(2, 2, figsize=(8, 8))
+            axes = axes.flatten()
+            axes[0].set_title('Loss(C)')
+            axes[1].set_title('Loss(G)')
+            axes[2].set_title('Penalty(C)')
+            axes[3].set_title('Penalty(G)')
+            axes[0].plot(epoch_critic_scores[:epoch, 0])
+            axes[1].plot(epoch_generator_scores[:epoch, 0])
+            axes[2].plot(epoch_critic_scores[:epoch, 1])
+            axes[3].plot(epoch_generator_scores[:epoch, 1])
+
+            fig.tight_layout()
+            fig.savefig('{}/images/g_updates.png'.format(trial_path))
+            plt.close('all')
+
+            # save critic scores for interactive inspection
+            np.save('{}/critic_scores.npy'.format(trial_path),
+                    epoch_critic_scores)
+            np.save('{}/generator_scores.npy'.format(trial_path),
+                    epoch_generator_scores)
+
+            # plot and create midi from generated data
             if cond_var:
-                generator_scores.append(g_train_fn(batch_cond))
+                samples = g_gen_fn(fixed_noise, fixed_condition)
             else:
-                generator_scores.append(g_train_fn())
-            generator_iterations += 1
-
-        # add results to history
-        epoch_critic_scores[epoch-1] = np.mean(critic_scores, axis=0)
-        epoch_generator_scores[epoch-1] = np.mean(generator_scores, axis=0)
-        # Then we print the results for this epoch:
-        print("""Epoch {} of {} took {:.3f}s\t
-              Critic Loss {} \n\t\tGenerator Loss {}""".format(
-              epoch + 1, num_epochs, time.time() - start_time,
-              epoch_critic_scores[epoch-1], epoch_generator_scores[epoch-1]))
-
-        fig, axes = plt.subplots(2, 2, figsize=(8, 8))
-        axes = axes.flatten()
-        axes[0].set_title('Loss(C)')
-        axes[1].set_title('Loss(G)')
-        axes[2].set_title('Penalty(C)')
-        axes[3].set_title('Penalty(G)')
-        axes[0].plot(epoch_critic_scores[:epoch, 0])
-        axes[1].plot(epoch_generator_scores[:epoch, 0])
-        axes[2].plot(epoch_critic_scores[:epoch, 1])
-        axes[3].plot(epoch_generator_scores[:epoch, 1])
-
-        fig.tight_layout()
-        fig.savefig('{}/images/g_updates.png'.format(trial_path))
-        plt.close('all')
-
-        # save critic scores for interactive inspection
-        np.save('{}/critic_scores.npy'.format(trial_path),
-                epoch_critic_scores)
-        np.save('{}/generator_scores.npy'.format(trial_path),
-                epoch_generator_scores)
-
-        # plot and create midi from generated data
-        if cond_var:
-            samples = g_gen_fn(fixed_noise, fixed_condition)
-        else:
-            samples = g_gen_fn(fixed_noise)
-        plt.imsave('{}/images/gits_{}_o.png'.format(trial_path, epoch),
-                   (samples.reshape(12, 12, alphabet_size, n_steps)
-                           .transpose(0, 2, 1, 3)
-                           .reshape(12*alphabet_size, 12*n_steps)),
-                   cmap='bwr')
-        plt.imsave('{}/images/gits_{}_f.png'.format(trial_path, epoch),
-                   np.flipud((samples.reshape(12, 12, alphabet_size, n_steps)
-                           .transpose(0, 2, 1, 3)
-                           .reshape(12*alphabet_size, 12*n_steps))),
-                   cmap='bwr')
-        np.save('{}/samples/gits_{}.npy'.format(trial_path, epoch), samples)
-
-        # After half the epochs, we start decaying the learn rate towards zero
-        if weight_decay:
-            if epoch >= num_epochs // 2:
-                progress = float(epoch) / num_epochs
-                c_eta.set_value(lasagne.utils.floatX(
-                    c_initial_eta*2*(1 - progress)))
-                g_eta.set_value(lasagne.utils.floatX(
-                    g_initial_eta*2*(1 - progress)))
-
-        if (epoch % save_model_every) == 0:
-            np.savez('{}/models/gen_{}.npz'.format(trial_path, epoch),
-                     *lasagne.layers.get_all_param_values(generator))
-            np.savez('{}/models/crit_{}.npz'.format(trial_path, epoch),
-                     *lasagne.layers.get_all_param_values(critic))
+                samples = g_gen_fn(fixed_noise)
+            plt.imsave('{}/images/gits_{}_o.png'.format(trial_path, epoch),
+                       (samples.reshape(12, 12, alphabet_size, n_steps)
+                               .transpose(0, 2, 1, 3)
+                               .reshape(12*alphabet_size, 12*n_steps)),
+                       cmap='bwr')
+            plt.imsave('{}/images/gits_{}_f.png'.format(trial_path, epoch),
+                       np.flipud((samples.reshape(12, 12, alphabet_size, n_steps)
+                               .transpose(0, 2, 1, 3)
+                               .reshape(12*alphabet_size, 12*n_steps))),
+                       cmap='bwr')
+            np.save('{}/samples/gits_{}.npy'.format(trial_path, epoch), samples)
+
+            if (epoch % save_model_every) == 0:
+                np.savez('{}/models/gen_{}.npz'.format(trial_path, epoch),
+                         *lasagne.layers.get_all_param_values(generator))
+                np.savez('{}/models/crit_{}.npz'.format(trial_path, epoch),
+                         *lasagne.layers.get_all_param_values(critic))
+
+    def run(rank):
+        try:
+            train(rank)
+        except:
+            if averagers:
+                barrier.abort()
+            raise
+
+    procs = [mp.Process(target=run, args=(rank,))
+             for rank in range(1, n_procs)]
+    for proc in procs:
+        proc.start()
+    run(0)
+    for proc in procs:
+        proc.join()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -423,6 +602,20 @@ if __name__ == '__main__':
                         help="Save model every?")
     parser.add_argument("--lambd", type=int, default=10,
                         help="Norm Penalty Coefficient")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Batches prefetched in background, 0 disables")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Batch worker processes, 0 uses a thread")
+    parser.add_argument("--scan_critic", type=int, default=0,
+                        help="Run the critic iterations in one theano scan")
+    parser.add_argument("--procs", type=int, default=1,
+                        help="Data parallel training processes, each takes "
+                             "optimizer steps on a shard of the batch and "
+                             "the parameters are averaged after each step")
+    parser.add_argument("--baseline", type=float, default=0,
+                        help="Samples/s of a --procs 1 run, to report the "
+                             "scaling efficiency against, 0 times one "
+                             "process before training")
 
     args = parser.parse_args()
 
@@ -438,4 +631,5 @@ if __name__ == '__main__':
          args.epoch_size, args.bs, args.clr, args.glr, args.clip,
          args.noise_size, args.boolean, args.condition, args.cbn, args.gbn,
          args.c_iters, args.cl_iters, args.loss_type, args.cl_freq, args.decay,
-         args.save_model_every, trial_path, args.lambd)
+         args.save_model_every, trial_path, args.lambd, args.prefetch,
+         args.workers, args.scan_critic, args.procs, args.baseline)
@@ -21,7 +21,9 @@ import tflib.plot
 import pdb
 
 from data_processing import load_proll_data, iterate_minibatches_proll
-from data_processing import load_text_data, iterate_minibatches_text
+from data_processing import load_text_corpus, iterate_minibatches_text
+from data_processing import proll_input_pipeline, text_input_pipeline
+from data_processing import BatchPrefetcher, SharedBatchProducer
 from text_utils import textEncoder
 
 MODE = 'wgan-gp' # dcgan, wgan, wgan-gp, lsgan
@@ -31,6 +33,13 @@ N_GPUS = 1 # Number of GPUs
 BATCH_SIZE = 64 # Batch size. Must be a multiple of N_GPUS
 ITERS = 10000 # How many iterations to train for
 LAMBDA = 10 # Gradient penalty lambda hyperparameter
+PREFETCH_DEPTH = 4 # Batches built in background, 0 disables
+N_DATA_WORKERS = 0 # Batch worker processes, 0 uses a thread
+SPARSE_PROLL = False # Keep piano rolls as CSR frames, densify batches
+PITCH_SHIFT = 0 # Max random transposition of proll batches, 0 disables
+TIME_STRETCH = 1 # Max random frame repetition of proll batches
+DATA_SEED = 1234 # Seed of the data split and of the batch streams
+USE_TF_DATA = hasattr(tf, 'data') # Build training batches in the graph
 N_CHANNELS = 1
 OUTPUT_DIM = 64*64*N_CHANNELS # Number of pixels in each iamge
 WEIGHT_INIT_SD = 0.05
@@ -40,6 +49,10 @@ WGAN_GP_CLR = 1e-5
 ARCH = 'dcgan'
 DATATYPE = 'proll'
 
+if USE_TF_DATA and SPARSE_PROLL and DATATYPE == 'proll':
+    raise Exception("The tf.data pipeline reads dense or bit-packed piano "
+                    "rolls, set SPARSE_PROLL or USE_TF_DATA to False")
+
 lib.print_model_settings(locals().copy())
 
 def GeneratorAndDiscriminator():
@@ -433,8 +446,117 @@ def DCGANDiscriminator(inputs, dim=DIM, bn=True, nonlinearity=LeakyReLU):
 
 Generator, Discriminator = GeneratorAndDiscriminator()
 
+# load data, batch worker processes are forked before the session starts
+# its thread pools
+if DATATYPE == 'text':
+    datapaths = (
+        '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/train.csv',
+        '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/test.csv')
+
+    as_dict = False
+    data_cols = (2, 1)
+    label_cols = (0, 0)
+    n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
+    n_steps = 64
+    patch_size = False
+    cache_dir = '/media/steampunkhd/rafaelvalle/datasets/TEXT/cache'
+    alphabet = [chr(i).lower() for i in range(32, 95)]
+    # alphabet = [chr(x) for x in range(127)]
+    # alphabet = list("abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+ =<>()[]{}")
+    padding = 'repeat'
+    encoder = textEncoder(alphabet)
+    # encoded once and cached, batches only slice codes
+    inputs, labels = load_text_corpus(
+        datapaths, data_cols, label_cols, n_pieces, encoder, cache_dir,
+        patch_size=n_steps)
+    alphabet_size = len(encoder.alphabet) + 1
+    pkl.dump(encoder, open("encdec.pkl", "wb"))
+    iterator = functools.partial(
+        iterate_minibatches_text, encoder=encoder, padding=padding,
+        alphabet_size=alphabet_size, n_buffers=PREFETCH_DEPTH + 2)
+    i_len = 64
+elif DATATYPE == 'proll':
+    datapath = '/media/steampunkhd/rafaelvalle/datasets/MIDI/Chorales'
+    glob_file_str = '*.npy'
+    as_dict = False
+    n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
+    crop = (32, 96)
+    n_steps = 64
+    i_len = 64
+    patch_size = False
+    alphabet_size = 64
+    threshold = 0.5
+    cache_dir = datapath + '_cache'
+    inputs, labels = load_proll_data(
+        datapath, glob_file_str, n_pieces, crop, as_dict,
+        patch_size=patch_size, threshold=threshold, cache_dir=cache_dir,
+        sparse=SPARSE_PROLL, bits=bool(threshold))
+    if len(inputs) == 0:
+        raise Exception("No inputs")
+    labels = np.array(labels)
+    iterator = functools.partial(
+        iterate_minibatches_proll, n_buffers=PREFETCH_DEPTH + 2,
+        max_shift=PITCH_SHIFT, max_stretch=TIME_STRETCH)
+
+# shuffle data
+inputs = inputs[np.random.RandomState(DATA_SEED).permutation(len(inputs))]
+
+# ATTENTION: INPUTS AND LABELS ARE NOT ALIGNED!
+point_du_rupture = int(len(inputs)*0.8)
+train_iterator = functools.partial(
+    iterator, inputs[:point_du_rupture], labels[:point_du_rupture],
+    BATCH_SIZE, shuffle=True, length=i_len, forever=True,
+    seed=DATA_SEED)
+dev_iterator = functools.partial(
+    iterator, inputs[point_du_rupture:], labels[point_du_rupture:],
+    BATCH_SIZE, shuffle=True, length=i_len, forever=True,
+    seed=DATA_SEED + 1)
+# batches are drawn from seeded streams, a run is reproducible
+train_start = dev_start = 0
+n_slots = PREFETCH_DEPTH + N_DATA_WORKERS + 1
+if USE_TF_DATA:
+    # training batches are built in the graph, see all_real_data_conv
+    train_gen = None
+elif N_DATA_WORKERS:
+    # each worker owns every N_DATA_WORKERS-th batch of the stream
+    train_gen = SharedBatchProducer(
+        lambda worker_id: train_iterator(
+            start=train_start + worker_id, step=N_DATA_WORKERS),
+        N_DATA_WORKERS, n_slots)
+elif PREFETCH_DEPTH:
+    train_gen = BatchPrefetcher(train_iterator(start=train_start),
+                                depth=PREFETCH_DEPTH)
+else:
+    train_gen = train_iterator(start=train_start)
+if N_DATA_WORKERS:
+    dev_gen = SharedBatchProducer(
+        lambda worker_id: dev_iterator(start=dev_start), 1, n_slots,
+        seed=4321)
+elif PREFETCH_DEPTH:
+    dev_gen = BatchPrefetcher(dev_iterator(start=dev_start),
+                              depth=PREFETCH_DEPTH)
+else:
+    dev_gen = dev_iterator(start=dev_start)
+
 with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
-    all_real_data_conv = tf.placeholder(tf.float32, shape=[BATCH_SIZE, N_CHANNELS, 64, 64])
+    if USE_TF_DATA:
+        if PITCH_SHIFT or TIME_STRETCH > 1:
+            raise Exception("Augmentation is only done by the Python iterators")
+        # feeding all_real_data_conv, as for dev batches, bypasses the pipeline
+        if DATATYPE == 'text':
+            train_batch = text_input_pipeline(
+                session, inputs[:point_du_rupture], BATCH_SIZE, i_len,
+                alphabet_size, padding, N_CHANNELS, seed=DATA_SEED,
+                start=train_start, prefetch=max(PREFETCH_DEPTH, 1))
+        else:
+            train_batch = proll_input_pipeline(
+                session, inputs[:point_du_rupture], BATCH_SIZE, i_len,
+                N_CHANNELS, seed=DATA_SEED, start=train_start,
+                prefetch=max(PREFETCH_DEPTH, 1))
+        all_real_data_conv = tf.placeholder_with_default(
+            train_batch, shape=[BATCH_SIZE, N_CHANNELS, 64, 64])
+    else:
+        all_real_data_conv = tf.placeholder(tf.float32, shape=[BATCH_SIZE, N_CHANNELS, 64, 64])
     if tf.__version__.startswith('1.'):
         split_real_data_conv = tf.split(all_real_data_conv, len(DEVICES))
     else:
@@ -560,63 +682,6 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
         lib.save_images.save_images(
             samples.reshape((BATCH_SIZE, N_CHANNELS, 64, 64)),
             '{}/{}/{}/samples_{}.png'.format(DATATYPE, MODE, ARCH, iteration))
-    # load data
-    if DATATYPE == 'text':
-        datapaths = (
-            '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/train.csv',
-            '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/test.csv')
-
-        as_dict = False
-        data_cols = (2, 1)
-        label_cols = (0, 0)
-        n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
-        n_steps = 64
-        patch_size = False
-        inputs, labels = load_text_data(
-            datapaths, data_cols, label_cols, n_pieces, as_dict,
-            patch_size=n_steps)
-        alphabet = [chr(i).lower() for i in range(32, 95)]
-        # alphabet = [chr(x) for x in range(127)]
-        # alphabet = list("abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+ =<>()[]{}")
-        padding = 'repeat'
-        encoder = textEncoder(alphabet)
-        alphabet_size = len(encoder.alphabet) + 1
-        pkl.dump(encoder, open("encdec.pkl", "wb"))
-        iterator = functools.partial(
-            iterate_minibatches_text, encoder=encoder, padding=padding,
-            alphabet_size=alphabet_size)
-        i_len = 64
-    elif DATATYPE == 'proll':
-        datapath = '/media/steampunkhd/rafaelvalle/datasets/MIDI/Chorales'
-        glob_file_str = '*.npy'
-        as_dict = False
-        n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
-        crop = (32, 96)
-        n_steps = 64
-        i_len = 64
-        patch_size = False
-        alphabet_size = 64
-        threshold = 0.5
-        inputs, labels = load_proll_data(
-            datapath, glob_file_str, n_pieces, crop, as_dict,
-            patch_size=patch_size, threshold=threshold)
-        if len(inputs) == 0:
-            raise Exception("No inputs")
-        labels = np.array(labels)
-        iterator = iterate_minibatches_proll
-
-    # shuffle data
-    np.random.shuffle(inputs)
-
-    # ATTENTION: INPUTS AND LABELS ARE NOT ALIGNED!
-    point_du_rupture = int(len(inputs)*0.8)
-    train_gen = iterator(
-        inputs[:point_du_rupture], labels[:point_du_rupture], BATCH_SIZE,
-        shuffle=True, length=i_len, forever=True)
-    dev_gen = iterator(
-        inputs[point_du_rupture:], labels[point_du_rupture:], BATCH_SIZE,
-        shuffle=True, length=i_len, forever=True)
-
     """
     # Dataset iterator
     # train_gen, dev_gen = lib.small_imagenet.load(BATCH_SIZE, data_dir=DATA_DIR)
@@ -627,7 +692,10 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
     # Save a batch of ground-truth samples
     # _x = inf_train_gen().next()
     """
-    _x, _ = train_gen.next()
+    if USE_TF_DATA:
+        _x = session.run(all_real_data_conv)
+    else:
+        _x, _ = train_gen.next()
     _x = _x.reshape((BATCH_SIZE, N_CHANNELS, alphabet_size, i_len))
     _x_r = session.run(real_data, feed_dict={real_data_conv: _x})
     _x_r = ((_x_r+1.)*(255.99/2)).astype('int32')
@@ -644,7 +712,9 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
         start_time = time.time()
 
         # Train generator
-        if iteration > 0:
+        if iteration > 0 and USE_TF_DATA:
+            _ = session.run(gen_train_op)
+        elif iteration > 0:
             _data, _ = train_gen.next()
             _data = _data.reshape((BATCH_SIZE, N_CHANNELS, alphabet_size, i_len))
             _ = session.run(gen_train_op, feed_dict={all_real_data_conv: _data})
@@ -656,12 +726,17 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
             disc_iters = CRITIC_ITERS
 
         for i in range(disc_iters):
-            _data, _ = train_gen.next()
-            _data = _data.reshape((BATCH_SIZE, N_CHANNELS, alphabet_size, i_len))
-            _disc_cost, _, _fake_data = session.run([disc_cost, disc_train_op, fake_data], feed_dict={all_real_data_conv: _data})
+            if USE_TF_DATA:
+                _disc_cost, _, _fake_data = session.run([disc_cost, disc_train_op, fake_data])
+            else:
+                _data, _ = train_gen.next()
+                _data = _data.reshape((BATCH_SIZE, N_CHANNELS, alphabet_size, i_len))
+                _disc_cost, _, _fake_data = session.run([disc_cost, disc_train_op, fake_data], feed_dict={all_real_data_conv: _data})
             if MODE == 'wgan':
                 _ = session.run([clip_disc_weights])
         lib.plot.plot('train disc cost', _disc_cost)
+        if not USE_TF_DATA and (N_DATA_WORKERS or PREFETCH_DEPTH):
+            lib.plot.plot('train starved', train_gen.stats()['starved_ratio'])
         lib.plot.plot('time', time.time() - start_time)
 
 
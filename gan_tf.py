@@ -21,19 +21,33 @@ import tflib.plot
 import pdb
 
 from data_processing import load_proll_data, iterate_minibatches_proll
-from data_processing import load_text_data, iterate_minibatches_text
+from data_processing import load_text_corpus, iterate_minibatches_text
+from data_processing import BatchPrefetcher, SharedBatchProducer
+from data_processing import proll_input_pipeline, text_input_pipeline
 from text_utils import textEncoder
 
-N_GPUS = 1 # number of GPUs
+N_TOWERS = 1 # Model replicas, each on a shard of the batch
+TOWER_DEVICE = 'gpu' # gpu, or cpu for CPU towers
+TOWER_THREADS = 0 # Intra-op threads per CPU tower, 0 lets TF decide
+TOWER_NUMA = True # Spread CPU towers over NUMA nodes when TF supports it
+BENCHMARK_ITERS = 0 # Time this many training steps and exit, 0 trains
 NAME = 'piano'
 MODE = 'wgan-gp' # dcgan, wgan, wgan-gp, lsgan
 DIM = 64 # Model dimensionality
 CRITIC_ITERS = 10 # How many iterations to train the critic for
-BATCH_SIZE = 64 # Batch size. Must be a multiple of N_GPUS
+BATCH_SIZE = 64 # Batch size. Must be a multiple of N_TOWERS
 BEGIN_ITERS = 60000
 ITERS = 70000 # How many iterations to train for
 MODEL = './piano_proll_wgan-gp_model.ckpt-59999'
 LAMBDA = 10 # Gradient penalty lambda hyperparameter
+PREFETCH_DEPTH = 4 # Batches built in background, 0 disables
+N_DATA_WORKERS = 0 # Batch worker processes, 0 uses a thread
+SPARSE_PROLL = False # Keep piano rolls as CSR frames, densify batches
+PITCH_SHIFT = 0 # Max random transposition of proll batches, 0 disables
+TIME_STRETCH = 1 # Max random frame repetition of proll batches
+DATA_SEED = 1234 # Seed of the data split and of the batch streams
+USE_TF_DATA = hasattr(tf, 'data') # Build training batches in the graph
+FUSED_STEP = False # Run critic iterations and generator update as one op
 N_CHANNELS = 1
 OUTPUT_DIM = 64*64*N_CHANNELS # Number of pixels in each iamge
 WEIGHT_INIT_SD = 0.005
@@ -42,7 +56,11 @@ WGAN_GP_GLR = 1e-5
 WGAN_GP_CLR = 1e-5
 ARCH = 'dcgan'
 DATATYPE = 'proll'
-DEVICES = ['/gpu:{}'.format(i) for i in xrange(N_GPUS)]
+DEVICES = ['/{}:{}'.format(TOWER_DEVICE, i) for i in xrange(N_TOWERS)]
+
+if USE_TF_DATA and SPARSE_PROLL and DATATYPE == 'proll':
+    raise Exception("The tf.data pipeline reads dense or bit-packed piano "
+                    "rolls, set SPARSE_PROLL or USE_TF_DATA to False")
 
 lib.print_model_settings(locals().copy())
 
@@ -380,102 +398,301 @@ def DCGANDiscriminator(inputs, dim=DIM, bn=True, nonlinearity=LeakyReLU):
 
 Generator, Discriminator = GeneratorAndDiscriminator()
 
-with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
-    all_real_data_conv = tf.placeholder(tf.float32, shape=[BATCH_SIZE, N_CHANNELS, 64, 64])
-    if tf.__version__.startswith('1.'):
-        split_real_data_conv = tf.split(all_real_data_conv, len(DEVICES))
+def SessionConfig():
+    """
+    CPU towers each get a TF CPU device and, with TOWER_THREADS, the
+    intra-op pool is sized for all towers and inter-op threads let the
+    towers run concurrently. With NUMA affinity TF makes one CPU device per
+    NUMA node, each with its own intra-op threads, so a tower's threads
+    and memory stay on its node.
+    """
+    config = tf.ConfigProto(allow_soft_placement=True)
+    if TOWER_DEVICE == 'cpu':
+        config.device_count['CPU'] = N_TOWERS
+        if TOWER_THREADS:
+            config.intra_op_parallelism_threads = N_TOWERS * TOWER_THREADS
+            config.inter_op_parallelism_threads = N_TOWERS
+        if TOWER_NUMA and hasattr(config, 'experimental') and hasattr(
+                config.experimental, 'use_numa_affinity'):
+            config.experimental.use_numa_affinity = True
+    return config
+
+# load data, batch worker processes are forked before the session starts
+# its thread pools
+if DATATYPE == 'text':
+    datapaths = (
+        '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/train.csv',
+        '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/test.csv')
+
+    as_dict = False
+    data_cols = (2, 1)
+    label_cols = (0, 0)
+    n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
+    n_steps = 64
+    patch_size = False
+    cache_dir = '/media/steampunkhd/rafaelvalle/datasets/TEXT/cache'
+    alphabet = [chr(i).lower() for i in range(32, 95)]
+    # alphabet = [chr(x) for x in range(127)]
+    # alphabet = list("abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+ =<>()[]{}")
+    padding = 'repeat'
+    encoder = textEncoder(alphabet)
+    # encoded once and cached, batches only slice codes
+    inputs, labels = load_text_corpus(
+        datapaths, data_cols, label_cols, n_pieces, encoder, cache_dir,
+        patch_size=n_steps)
+    alphabet_size = len(encoder.alphabet) + 1
+    pkl.dump(encoder, open("encdec.pkl", "wb"))
+    iterator = functools.partial(
+        iterate_minibatches_text, encoder=encoder, padding=padding,
+        alphabet_size=alphabet_size, n_buffers=PREFETCH_DEPTH + 2)
+    i_len = 64
+elif DATATYPE == 'proll':
+    datapath = '/media/steampunkhd/rafaelvalle/datasets/MIDI/Piano'
+    glob_file_str = '*.npy'
+    as_dict = False
+    n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
+    crop = (32, 96)
+    n_steps = 64
+    i_len = 64
+    patch_size = False
+    alphabet_size = 64
+    threshold = 0.5
+    cache_dir = datapath + '_cache'
+    inputs, labels = load_proll_data(
+        datapath, glob_file_str, n_pieces, crop, as_dict,
+        patch_size=patch_size, threshold=threshold, cache_dir=cache_dir,
+        sparse=SPARSE_PROLL, bits=bool(threshold))
+    if len(inputs) == 0:
+        raise Exception("No inputs")
+    labels = np.array(labels)
+    iterator = functools.partial(
+        iterate_minibatches_proll, n_buffers=PREFETCH_DEPTH + 2,
+        max_shift=PITCH_SHIFT, max_stretch=TIME_STRETCH)
+
+# shuffle data
+inputs = inputs[np.random.RandomState(DATA_SEED).permutation(len(inputs))]
+
+# ATTENTION: INPUTS AND LABELS ARE NOT ALIGNED!
+point_du_rupture = int(len(inputs)*0.8)
+train_iterator = functools.partial(
+    iterator, inputs[:point_du_rupture], labels[:point_du_rupture],
+    BATCH_SIZE, shuffle=True, length=i_len, forever=True,
+    seed=DATA_SEED)
+dev_iterator = functools.partial(
+    iterator, inputs[point_du_rupture:], labels[point_du_rupture:],
+    BATCH_SIZE, shuffle=True, length=i_len, forever=True,
+    seed=DATA_SEED + 1)
+# batches are drawn from seeded streams, resuming at BEGIN_ITERS skips
+# straight to the batches the original run used from there on
+if (MODE == 'dcgan') or (MODE == 'lsgan'):
+    train_start = BEGIN_ITERS
+else:
+    train_start = BEGIN_ITERS * CRITIC_ITERS
+dev_start = BEGIN_ITERS // 200 * 10
+n_slots = PREFETCH_DEPTH + N_DATA_WORKERS + 1
+if USE_TF_DATA:
+    # training batches are built in the graph, see all_real_data_conv
+    train_gen = None
+elif N_DATA_WORKERS:
+    # each worker owns every N_DATA_WORKERS-th batch of the stream
+    train_gen = SharedBatchProducer(
+        lambda worker_id: train_iterator(
+            start=train_start + worker_id, step=N_DATA_WORKERS),
+        N_DATA_WORKERS, n_slots)
+elif PREFETCH_DEPTH:
+    train_gen = BatchPrefetcher(train_iterator(start=train_start),
+                                depth=PREFETCH_DEPTH)
+else:
+    train_gen = train_iterator(start=train_start)
+if N_DATA_WORKERS:
+    dev_gen = SharedBatchProducer(
+        lambda worker_id: dev_iterator(start=dev_start), 1, n_slots,
+        seed=4321)
+elif PREFETCH_DEPTH:
+    dev_gen = BatchPrefetcher(dev_iterator(start=dev_start),
+                              depth=PREFETCH_DEPTH)
+else:
+    dev_gen = dev_iterator(start=dev_start)
+
+with tf.Session(config=SessionConfig()) as session:
+    if (MODE == 'dcgan') or (MODE == 'lsgan'):
+        disc_iters = 1
     else:
-        split_real_data_conv = tf.split(0, len(DEVICES), all_real_data_conv)
-    gen_costs, disc_costs = [],[]
-
-    for device_index, (device, real_data_conv) in enumerate(zip(DEVICES, split_real_data_conv)):
-        with tf.device(device):
-            reg_noise = tf.random_normal(
-                    shape=[BATCH_SIZE/len(DEVICES), OUTPUT_DIM],
-                    mean=0., stddev=0.001)
-            real_data = tf.reshape(real_data_conv, [BATCH_SIZE/len(DEVICES), OUTPUT_DIM])
-            real_data += reg_noise
-            fake_data = Generator(BATCH_SIZE/len(DEVICES))
-
-            disc_real = Discriminator(real_data)
-            disc_fake = Discriminator(fake_data)
-
-            if MODE == 'wgan':
-                gen_cost = -tf.reduce_mean(disc_fake)
-                disc_cost = tf.reduce_mean(disc_fake) - tf.reduce_mean(disc_real)
-
-            elif MODE == 'wgan-gp':
-                gen_cost = -tf.reduce_mean(disc_fake)
-                disc_cost = tf.reduce_mean(disc_fake) - tf.reduce_mean(disc_real)
-
-                alpha = tf.random_uniform(
-                    shape=[BATCH_SIZE/len(DEVICES),1],
-                    minval=0.,
-                    maxval=1.
-                )
-                differences = fake_data - real_data
-                interpolates = real_data + (alpha*differences)
-                gradients = tf.gradients(Discriminator(interpolates), [interpolates])[0]
-                slopes = tf.sqrt(tf.reduce_sum(tf.square(gradients), reduction_indices=[1]))
-                gradient_penalty = tf.reduce_mean((slopes-1.)**2)
-                disc_cost += LAMBDA*gradient_penalty
-
-            elif MODE == 'dcgan':
-                try: # tf pre-1.0 (bottom) vs 1.0 (top)
-                    gen_cost = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=disc_fake,
-                                                                                      labels=tf.ones_like(disc_fake)))
-                    disc_cost =  tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=disc_fake,
-                                                                                        labels=tf.zeros_like(disc_fake)))
-                    disc_cost += tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=disc_real,
-                                                                                        labels=tf.ones_like(disc_real)))
-                except Exception as e:
-                    gen_cost = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(disc_fake, tf.ones_like(disc_fake)))
-                    disc_cost =  tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(disc_fake, tf.zeros_like(disc_fake)))
-                    disc_cost += tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(disc_real, tf.ones_like(disc_real)))
-                disc_cost /= 2.
-
-            elif MODE == 'lsgan':
-                gen_cost = tf.reduce_mean((disc_fake - 1)**2)
-                disc_cost = (tf.reduce_mean((disc_real - 1)**2) + tf.reduce_mean((disc_fake - 0)**2))/2.
-
-            else:
-                raise Exception()
-
-            gen_costs.append(gen_cost)
-            disc_costs.append(disc_cost)
-
+        disc_iters = CRITIC_ITERS
+
+    if FUSED_STEP and not USE_TF_DATA:
+        raise Exception("The fused step needs the tf.data pipeline")
+    if USE_TF_DATA:
+        if PITCH_SHIFT or TIME_STRETCH > 1:
+            raise Exception("Augmentation is only done by the Python iterators")
+        # the fused step takes the batches of all its critic iterations at once
+        steps = disc_iters if FUSED_STEP else None
+        # feeding all_real_data_conv, as for dev batches, bypasses the pipeline
+        if DATATYPE == 'text':
+            train_batch = text_input_pipeline(
+                session, inputs[:point_du_rupture], BATCH_SIZE, i_len,
+                alphabet_size, padding, N_CHANNELS, seed=DATA_SEED,
+                start=train_start, prefetch=max(PREFETCH_DEPTH, 1),
+                steps=steps)
+        else:
+            train_batch = proll_input_pipeline(
+                session, inputs[:point_du_rupture], BATCH_SIZE, i_len,
+                N_CHANNELS, seed=DATA_SEED, start=train_start,
+                prefetch=max(PREFETCH_DEPTH, 1), steps=steps)
+        if FUSED_STEP:
+            train_steps, train_batch = train_batch, train_batch[0]
+        all_real_data_conv = tf.placeholder_with_default(
+            train_batch, shape=[BATCH_SIZE, N_CHANNELS, 64, 64])
+    else:
+        all_real_data_conv = tf.placeholder(tf.float32, shape=[BATCH_SIZE, N_CHANNELS, 64, 64])
+    def build_costs(all_real_data_conv):
+        """
+        Generator and critic costs of each of DEVICES, with the real data
+        of all devices concatenated, which the ground truth plot fetches
+        """
+        if tf.__version__.startswith('1.'):
+            split_real_data_conv = tf.split(all_real_data_conv, len(DEVICES))
+        else:
+            split_real_data_conv = tf.split(0, len(DEVICES), all_real_data_conv)
+        gen_costs, disc_costs, real_datas = [],[],[]
+
+        for device_index, (device, real_data_conv) in enumerate(zip(DEVICES, split_real_data_conv)):
+            with tf.device(device):
+                reg_noise = tf.random_normal(
+                        shape=[BATCH_SIZE/len(DEVICES), OUTPUT_DIM],
+                        mean=0., stddev=0.001)
+                real_data = tf.reshape(real_data_conv, [BATCH_SIZE/len(DEVICES), OUTPUT_DIM])
+                real_data += reg_noise
+                fake_data = Generator(BATCH_SIZE/len(DEVICES))
+
+                disc_real = Discriminator(real_data)
+                disc_fake = Discriminator(fake_data)
+
+                if MODE == 'wgan':
+                    gen_cost = -tf.reduce_mean(disc_fake)
+                    disc_cost = tf.reduce_mean(disc_fake) - tf.reduce_mean(disc_real)
+
+                elif MODE == 'wgan-gp':
+                    gen_cost = -tf.reduce_mean(disc_fake)
+                    disc_cost = tf.reduce_mean(disc_fake) - tf.reduce_mean(disc_real)
+
+                    alpha = tf.random_uniform(
+                        shape=[BATCH_SIZE/len(DEVICES),1],
+                        minval=0.,
+                        maxval=1.
+                    )
+                    differences = fake_data - real_data
+                    interpolates = real_data + (alpha*differences)
+                    gradients = tf.gradients(Discriminator(interpolates), [interpolates])[0]
+                    slopes = tf.sqrt(tf.reduce_sum(tf.square(gradients), reduction_indices=[1]))
+                    gradient_penalty = tf.reduce_mean((slopes-1.)**2)
+                    disc_cost += LAMBDA*gradient_penalty
+
+                elif MODE == 'dcgan':
+                    try: # tf pre-1.0 (bottom) vs 1.0 (top)
+                        gen_cost = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=disc_fake,
+                                                                                          labels=tf.ones_like(disc_fake)))
+                        disc_cost =  tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=disc_fake,
+                                                                                            labels=tf.zeros_like(disc_fake)))
+                        disc_cost += tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=disc_real,
+                                                                                            labels=tf.ones_like(disc_real)))
+                    except Exception as e:
+                        gen_cost = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(disc_fake, tf.ones_like(disc_fake)))
+                        disc_cost =  tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(disc_fake, tf.zeros_like(disc_fake)))
+                        disc_cost += tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(disc_real, tf.ones_like(disc_real)))
+                    disc_cost /= 2.
+
+                elif MODE == 'lsgan':
+                    gen_cost = tf.reduce_mean((disc_fake - 1)**2)
+                    disc_cost = (tf.reduce_mean((disc_real - 1)**2) + tf.reduce_mean((disc_fake - 0)**2))/2.
+
+                else:
+                    raise Exception()
+
+                gen_costs.append(gen_cost)
+                disc_costs.append(disc_cost)
+                real_datas.append(real_data)
+
+        if tf.__version__.startswith('1.'):
+            real_data = tf.concat(real_datas, 0)
+        else:
+            real_data = tf.concat(0, real_datas)
+        return gen_costs, disc_costs, real_data
+
+    def tower_train_op(optimizer, tower_costs, var_list):
+        # each tower differentiates its own cost on its device and the
+        # gradients, rather than the costs, are averaged
+        tower_grads = []
+        for device, cost in zip(DEVICES, tower_costs):
+            with tf.device(device):
+                tower_grads.append(tf.gradients(cost, var_list))
+        grads = [tf.add_n(list(grad)) / len(DEVICES)
+                 for grad in zip(*tower_grads)]
+        return optimizer.apply_gradients(zip(grads, var_list))
+
+    gen_costs, disc_costs, real_data = build_costs(
+        all_real_data_conv)
     gen_cost = tf.add_n(gen_costs) / len(DEVICES)
     disc_cost = tf.add_n(disc_costs) / len(DEVICES)
 
     if MODE == 'wgan':
-        gen_train_op = tf.train.RMSPropOptimizer(learning_rate=5e-5).minimize(gen_cost,
-                                             var_list=lib.params_with_name('Generator'), colocate_gradients_with_ops=True)
-        disc_train_op = tf.train.RMSPropOptimizer(learning_rate=5e-5).minimize(disc_cost,
-                                             var_list=lib.params_with_name('Discriminator.'), colocate_gradients_with_ops=True)
-        clip_ops = []
-        for var in lib.params_with_name('Discriminator'):
-            clip_bounds = [-.01, .01]
-            clip_ops.append(tf.assign(var, tf.clip_by_value(var, clip_bounds[0], clip_bounds[1])))
-        clip_disc_weights = tf.group(*clip_ops)
+        gen_optimizer = tf.train.RMSPropOptimizer(learning_rate=5e-5)
+        disc_optimizer = tf.train.RMSPropOptimizer(learning_rate=5e-5)
     elif MODE == 'wgan-gp':
-        gen_train_op = tf.train.AdamOptimizer(
-            learning_rate=WGAN_GP_GLR, beta1=0.5, beta2=0.9).minimize(gen_cost,
-            var_list=lib.params_with_name('Generator'), colocate_gradients_with_ops=True)
-        disc_train_op = tf.train.AdamOptimizer(
-            learning_rate=WGAN_GP_CLR, beta1=0.5, beta2=0.9).minimize(disc_cost,
-            var_list=lib.params_with_name('Discriminator.'), colocate_gradients_with_ops=True)
+        gen_optimizer = tf.train.AdamOptimizer(
+            learning_rate=WGAN_GP_GLR, beta1=0.5, beta2=0.9)
+        disc_optimizer = tf.train.AdamOptimizer(
+            learning_rate=WGAN_GP_CLR, beta1=0.5, beta2=0.9)
     elif MODE == 'dcgan':
-        gen_train_op = tf.train.AdamOptimizer(learning_rate=2e-4, beta1=0.5).minimize(gen_cost,
-                                          var_list=lib.params_with_name('Generator'), colocate_gradients_with_ops=True)
-        disc_train_op = tf.train.AdamOptimizer(learning_rate=2e-4, beta1=0.5).minimize(disc_cost,
-                                           var_list=lib.params_with_name('Discriminator.'), colocate_gradients_with_ops=True)
+        gen_optimizer = tf.train.AdamOptimizer(learning_rate=2e-4, beta1=0.5)
+        disc_optimizer = tf.train.AdamOptimizer(learning_rate=2e-4, beta1=0.5)
     elif MODE == 'lsgan':
-        gen_train_op = tf.train.RMSPropOptimizer(learning_rate=1e-4).minimize(gen_cost,
-                                             var_list=lib.params_with_name('Generator'), colocate_gradients_with_ops=True)
-        disc_train_op = tf.train.RMSPropOptimizer(learning_rate=1e-4).minimize(disc_cost,
-                                              var_list=lib.params_with_name('Discriminator.'), colocate_gradients_with_ops=True)
+        gen_optimizer = tf.train.RMSPropOptimizer(learning_rate=1e-4)
+        disc_optimizer = tf.train.RMSPropOptimizer(learning_rate=1e-4)
     else:
         raise Exception()
+    gen_params = lib.params_with_name('Generator')
+    disc_params = lib.params_with_name('Discriminator.')
+    gen_train_op = tower_train_op(gen_optimizer, gen_costs, gen_params)
+    disc_train_op = tower_train_op(disc_optimizer, disc_costs, disc_params)
+
+    def clip_disc_weights_op():
+        clip_ops = []
+        for var in lib.params_with_name('Discriminator'):
+            clip_bounds = [-.01, .01]
+            clip_ops.append(tf.assign(var, tf.clip_by_value(var, clip_bounds[0], clip_bounds[1])))
+        return tf.group(*clip_ops)
+    if MODE == 'wgan':
+        clip_disc_weights = clip_disc_weights_op()
+
+    if FUSED_STEP:
+        # disc_iters critic updates in a tf.while_loop, each on its own
+        # batch of train_steps, then the generator update. Optimizer slots
+        # already exist from the train ops above, so no variable is created
+        # in the loop. The counter i of an iteration is only produced once
+        # the previous update is done, and every op of the iteration,
+        # weight and slot reads included, waits for it, so each update sees
+        # the weights left by the previous one.
+        def critic_step(i, _):
+            with tf.control_dependencies([i]):
+                _, step_disc_costs, _ = build_costs(
+                    tf.gather(train_steps, i))
+                update = tower_train_op(disc_optimizer, step_disc_costs,
+                                        disc_params)
+            if MODE == 'wgan':
+                with tf.control_dependencies([update]):
+                    update = clip_disc_weights_op()
+            with tf.control_dependencies([update]):
+                return i + 1, tf.add_n(step_disc_costs) / len(DEVICES)
+
+        _, step_disc_cost = tf.while_loop(
+            lambda i, _: i < disc_iters, critic_step,
+            [tf.constant(0), tf.constant(0.)], parallel_iterations=1)
+        with tf.control_dependencies([step_disc_cost]):
+            step_gen_costs, _, _ = build_costs(train_batch)
+            train_step = tower_train_op(gen_optimizer, step_gen_costs,
+                                        gen_params)
+
     # computing gradients of loss wrt to weights
     disc_grad = tf.gradients(
         disc_cost, [tf.trainable_variables()[18], tf.trainable_variables()[-2]])
@@ -500,63 +717,6 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
         lib.save_images.save_images(
             samples.reshape((BATCH_SIZE, N_CHANNELS, 64, 64)),
             '{}/{}/{}/{}_samples_{}.png'.format(DATATYPE, MODE, ARCH, NAME, iteration))
-    # load data
-    if DATATYPE == 'text':
-        datapaths = (
-            '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/train.csv',
-            '/media/steampunkhd/rafaelvalle/datasets/TEXT/ag_news_csv/test.csv')
-
-        as_dict = False
-        data_cols = (2, 1)
-        label_cols = (0, 0)
-        n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
-        n_steps = 64
-        patch_size = False
-        inputs, labels = load_text_data(
-            datapaths, data_cols, label_cols, n_pieces, as_dict,
-            patch_size=n_steps)
-        alphabet = [chr(i).lower() for i in range(32, 95)]
-        # alphabet = [chr(x) for x in range(127)]
-        # alphabet = list("abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+ =<>()[]{}")
-        padding = 'repeat'
-        encoder = textEncoder(alphabet)
-        alphabet_size = len(encoder.alphabet) + 1
-        pkl.dump(encoder, open("encdec.pkl", "wb"))
-        iterator = functools.partial(
-            iterate_minibatches_text, encoder=encoder, padding=padding,
-            alphabet_size=alphabet_size)
-        i_len = 64
-    elif DATATYPE == 'proll':
-        datapath = '/media/steampunkhd/rafaelvalle/datasets/MIDI/Piano'
-        glob_file_str = '*.npy'
-        as_dict = False
-        n_pieces = 0  # 0 is equal to all examples, unbalanced dataset
-        crop = (32, 96)
-        n_steps = 64
-        i_len = 64
-        patch_size = False
-        alphabet_size = 64
-        threshold = 0.5
-        inputs, labels = load_proll_data(
-            datapath, glob_file_str, n_pieces, crop, as_dict,
-            patch_size=patch_size, threshold=threshold)
-        if len(inputs) == 0:
-            raise Exception("No inputs")
-        labels = np.array(labels)
-        iterator = iterate_minibatches_proll
-
-    # shuffle data
-    np.random.shuffle(inputs)
-
-    # ATTENTION: INPUTS AND LABELS ARE NOT ALIGNED!
-    point_du_rupture = int(len(inputs)*0.8)
-    train_gen = iterator(
-        inputs[:point_du_rupture], labels[:point_du_rupture], BATCH_SIZE,
-        shuffle=True, length=i_len, forever=True)
-    dev_gen = iterator(
-        inputs[point_du_rupture:], labels[point_du_rupture:], BATCH_SIZE,
-        shuffle=True, length=i_len, forever=True)
-
     """
     # Dataset iterator
     # train_gen, dev_gen = lib.small_imagenet.load(BATCH_SIZE, data_dir=DATA_DIR)
@@ -567,9 +727,12 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
     # Save a batch of ground-truth samples
     # _x = inf_train_gen().next()
     """
-    _x, _ = train_gen.next()
+    if USE_TF_DATA:
+        _x = session.run(all_real_data_conv)
+    else:
+        _x, _ = train_gen.next()
     _x = _x.reshape((BATCH_SIZE, N_CHANNELS, alphabet_size, i_len))
-    _x_r = session.run(real_data, feed_dict={real_data_conv: _x})
+    _x_r = session.run(real_data, feed_dict={all_real_data_conv: _x})
     _x_r = ((_x_r+1.)*(255.99/2)).astype('int32')
     lib.save_images.save_images(
         _x_r.reshape((BATCH_SIZE, N_CHANNELS, 64, 64)),
@@ -584,25 +747,48 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
 
     for iteration in range(BEGIN_ITERS, ITERS):
         # start_time = time.time()
+        if BENCHMARK_ITERS and iteration == BEGIN_ITERS + 1:
+            # the first step warms up and is not timed
+            benchmark_start = time.time()
+        elif BENCHMARK_ITERS and iteration == BEGIN_ITERS + 1 + BENCHMARK_ITERS:
+            elapsed = time.time() - benchmark_start
+            print("{} {} towers, {} threads each: {:.2f} steps/s, "
+                  "{:.1f} critic samples/s".format(
+                      N_TOWERS, TOWER_DEVICE, TOWER_THREADS or 'default',
+                      BENCHMARK_ITERS / elapsed,
+                      BENCHMARK_ITERS * disc_iters * BATCH_SIZE / elapsed))
+            break
+        log_iteration = not BENCHMARK_ITERS and (
+            (iteration < 5) or (iteration % 100 == 99))
+
+        if FUSED_STEP:
+            # critic iterations then generator update, one call
+            _disc_cost, _ = session.run([step_disc_cost, train_step])
+            if log_iteration:
+                # gradients are only plotted, taken on the ground truth batch
+                _disc_grad, _gen_grad = session.run(
+                    [disc_grad, gen_grad], feed_dict={all_real_data_conv: _x})
 
         # Train generator
-        if iteration > 0:
+        if iteration > 0 and not FUSED_STEP:
             _, _gen_grad = session.run([gen_train_op, gen_grad])
 
         # Train critic
-        if (MODE == 'dcgan') or (MODE == 'lsgan'):
-            disc_iters = 1
-        else:
-            disc_iters = CRITIC_ITERS
-
-        for i in range(disc_iters):
-            _data, _ = train_gen.next()
-            _data = _data.reshape((BATCH_SIZE, N_CHANNELS, alphabet_size, i_len))
-            _disc_cost, _, _disc_grad = session.run([disc_cost, disc_train_op, disc_grad], feed_dict={all_real_data_conv: _data})
+        for i in range(0 if FUSED_STEP else disc_iters):
+            if USE_TF_DATA:
+                _disc_cost, _, _disc_grad = session.run([disc_cost, disc_train_op, disc_grad])
+            else:
+                _data, _ = train_gen.next()
+                _data = _data.reshape((BATCH_SIZE, N_CHANNELS, alphabet_size, i_len))
+                _disc_cost, _, _disc_grad = session.run([disc_cost, disc_train_op, disc_grad], feed_dict={all_real_data_conv: _data})
             if MODE == 'wgan':
                 _ = session.run([clip_disc_weights])
+        if BENCHMARK_ITERS:
+            continue
         lib.plot.plot('train disc cost', _disc_cost)
-        if iteration > 0:
+        if not USE_TF_DATA and (N_DATA_WORKERS or PREFETCH_DEPTH):
+            lib.plot.plot('train starved', train_gen.stats()['starved_ratio'])
+        if iteration > 0 and (log_iteration or not FUSED_STEP):
             lib.plot.plot('dg0', np.mean(np.abs(_disc_grad[0])))
             lib.plot.plot('dg1', np.mean(np.abs(_disc_grad[1])))
             lib.plot.plot( 'gg0', np.mean(np.abs(_gen_grad[0])))
@@ -619,10 +805,11 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
                 dev_disc_costs.append(_dev_disc_cost)
             lib.plot.plot('dev disc cost', np.mean(dev_disc_costs))
             generate_image(iteration)
-        if (iteration < 5) or (iteration % 100 == 99):
+        if log_iteration:
             lib.plot.flush()
 
         lib.plot.tick()
 
-    saver.save(session,
-        '{}_{}_{}_model.ckpt'.format(NAME, DATATYPE, MODE), global_step=iteration)
+    if not BENCHMARK_ITERS:
+        saver.save(session,
+            '{}_{}_{}_model.ckpt'.format(NAME, DATATYPE, MODE), global_step=iteration)
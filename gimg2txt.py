@@ -14,14 +14,13 @@ def main(filepath, shape, decoder_path):
     n_rows = int(img.shape[0] / shape[0])
     n_cols = int(img.shape[1] / shape[1])
 
-    i = 0
+    # (n_rows, alphabet, n_cols, length) grid of patches, decoded at once
+    patches = img.reshape(
+        (n_rows, img.shape[0] // n_rows, n_cols, img.shape[1] // n_cols))
+    codes = np.argmax(patches, axis=1).reshape((n_rows * n_cols, -1))
     text = '{}\n'.format(filepath)
-    for row_imgs in np.split(img, n_rows, axis=0):
-        for col_img in np.split(row_imgs, n_cols, axis=1):
-            cur_txt = decoder.decode(np.argmax(col_img, axis=0))
-            cur_txt = ''.join(cur_txt)
-            text += '{}, {}\n'.format(i, cur_txt)
-            i += 1
+    for i, cur_txt in enumerate(decoder.decode_batch(codes)):
+        text += '{}, {}\n'.format(i, cur_txt)
     with open(filepath+'.txt', "w") as text_file:
         text_file.write(text)
 
@@ -33,75 +33,11 @@ import lasagne
 import cPickle as pkl
 from tqdm import tqdm
 
-from data_processing import load_text_data, encode_labels
+from data_processing import (
+    load_text_corpus, encode_labels, iterate_minibatches_text)
 from text_utils import textEncoder
 import pdb
 
-def pad(cur_data, alphabet_size, length, padding):
-    if padding is None:
-        # ignore examples shorter than length
-       return cur_data
-    elif padding == 'zero':
-        # zero pad data if shorter than length
-        z = np.zeros((alphabet_size, length))
-        z[:, :cur_data.shape[1]] = cur_data
-    elif padding == 'noise':
-        z = np.zeros((alphabet_size, length))
-        z[:, :cur_data.shape[1]] = cur_data
-        z[:, cur_data.shape[1]:] = np.random.normal(
-            0, 0.0001,
-            (cur_data.shape[0], length - cur_data.shape[1]))
-    elif padding == 'repeat':
-        z = np.zeros((alphabet_size, length))
-        z[:, :cur_data.shape[1]] = cur_data
-        # change to vector operation
-        for k in range(1, length - cur_data.shape[1]-1):
-            z[:, cur_data.shape[1] + k] = cur_data[
-                :, (k-1) % cur_data.shape[1]]
-    else:
-        raise Exception(
-            "Padding {} not supported".format(padding))
-    return z
-
-
-def iterate_minibatches_text(inputs, labels, batch_size, encoder, shuffle=True,
-                             forever=True, length=128, alphabet_size=128,
-                             padding='repeat'):
-    from text_utils import binarizeText
-    if shuffle:
-        indices = np.arange(len(inputs))
-    while True:
-        if shuffle:
-            np.random.shuffle(indices)
-        for start_idx in range(0, len(inputs) - batch_size + 1, batch_size):
-            if shuffle:
-                excerpt = indices[start_idx:start_idx + batch_size]
-            else:
-                excerpt = slice(start_idx, start_idx + batch_size)
-
-            data = []
-            # select random slice from each piano roll
-            for i in excerpt:
-                cur_data = binarizeText(
-                    inputs[i], encoder, lower_case=True, remove_html=False)
-                if cur_data.shape[1] < length:
-                    cur_data = pad(cur_data, alphabet_size, length, padding)
-                elif cur_data.shape[1] > length:
-                    # slice data if larger than length
-                    rand_start = np.random.randint(
-                        0, cur_data.shape[1] - length)
-                    cur_data = cur_data[:, rand_start:rand_start+length]
-                data.append(cur_data)
-            # scale to [-1, 1]
-            data = np.array(data)
-            data += data.min()
-            data /= data.max()
-            data = (data * 2) - 1
-            yield lasagne.utils.floatX(data), labels[excerpt]
-
-        if not forever:
-            break
-
 # ##################### Build the neural network model #######################
 # We create two models: The generator and the critic network.
 # The models are the same as in the Lasagne DCGAN example, except that the
@@ -266,23 +202,26 @@ def main(num_epochs=100, epochsize=100, batch_size=32, initial_deta=1e-4,
     as_dict = False
     n_timesteps = 128
     padding = 'repeat'
-    inputs, labels = load_text_data(
-        datapaths, data_cols, label_cols, n_pieces, as_dict,
+    cache_dir = '/Users/rafaelvalle/Desktop/datasets/TEXT/cache'
+    # alphabet = list("abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+ =<>()[]{}")
+    # 127 symbols + dustbin
+    alphabet = [chr(x) for x in range(127)]
+    encoder = textEncoder(alphabet)
+    alphabet_size = len(encoder.alphabet) + 1
+    pkl.dump(encoder, open("encdec.pkl", "wb"))
+    # encoded once and cached, batches only slice codes
+    inputs, labels = load_text_corpus(
+        datapaths, data_cols, label_cols, n_pieces, encoder, cache_dir,
         patch_size=n_timesteps)
 
     data_size = 5000
     inputs = inputs[:data_size]
     labels = labels[:data_size]
     iterator = iterate_minibatches_text
-    # alphabet = list("abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+ =<>()[]{}")
-    alphabet = [chr(x) for x in range(128)]
-    encoder = textEncoder(alphabet)
-    alphabet_size = len(encoder.alphabet)
-    pkl.dump(encoder, open("encdec.pkl", "wb"))
 
     # encode labels
     labels = encode_labels(labels, one_hot=True).astype(np.float32)
-    print("Dataset shape {}".format(inputs.shape))
+    print("Dataset shape ({}, ?)".format(len(inputs)))
 
     # Prepare Theano variables for inputs and targets
     # noise_var = T.fmatrix('noise')
@@ -350,7 +289,7 @@ def main(num_epochs=100, epochsize=100, batch_size=32, initial_deta=1e-4,
     print("Loading data...")
     batches = iterator(
         inputs, labels, batch_size, encoder, shuffle=True, length=n_timesteps,
-        forever=True, alphabet_size=len(encoder.alphabet), padding=padding)
+        forever=True, alphabet_size=alphabet_size, padding=padding)
 
     # create fixed-noise
     fixed_noise = lasagne.utils.floatX(np.random.rand(32, 128, 100))
@@ -385,9 +324,9 @@ def main(num_epochs=100, epochsize=100, batch_size=32, initial_deta=1e-4,
         samples = gen_fn(fixed_noise)
 
         plt.imsave('images/lsgan_text/lsgan_sample_{}.png'.format(epoch),
-                   (samples.reshape(4, 8, len(encoder.alphabet), n_timesteps)
+                   (samples.reshape(4, 8, alphabet_size, n_timesteps)
                            .transpose(0, 2, 1, 3)
-                           .reshape(4*len(encoder.alphabet), 8*n_timesteps)),
+                           .reshape(4*alphabet_size, 8*n_timesteps)),
                    origin='bottom',
                    cmap='gray')
 
@@ -4,42 +4,241 @@ matplotlib.use('Agg')
 import matplotlib.pylab as plt
 import traceback
 import argparse
+import functools
+import hashlib
+import json
+import os
 import sys
+import time
+import multiprocessing as mp
 import glob2 as glob
 import numpy as np
 import pretty_midi as pm
 from music_utils import quantize, interpolate_between_beats
+from data_processing import (
+    glob_proll_files, sources_key, proll_pitch_counts)
 
-def main(globstr, beat_subdivisions, fs, quantized, wrap, save_img, debug):
+
+def file_md5(filepath):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    # write then rename so an interrupted run never leaves a broken manifest
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def render_proll(filepath, beat_subdivisions, fs, quantized, wrap):
+    data = pm.PrettyMIDI(filepath)
+    b = data.get_beats()
+    beats = interpolate_between_beats(b, beat_subdivisions)
+    if quantized:
+        quantize(data, beats)
+    if not fs:
+        cur_fs = 1./beats[1]
+        while cur_fs > wrap:
+            cur_fs = cur_fs * 0.5
+    else:
+        cur_fs = fs
+    # proll = data.get_piano_roll(fs=fs, times=beats)
+    proll = data.get_piano_roll(fs=cur_fs).astype(int)
+    if np.isnan(proll).any():
+        print("{} had NaN cells".format(filepath))
+    return proll, cur_fs
+
+
+def convert(filepath, beat_subdivisions, fs, quantized, wrap, save_img,
+            debug):
+    """
+    Converts a single MIDI file to filepath.npy.
+    Returns (filepath, md5, fs, n_frames, error)
+    """
+    try:
+        md5 = file_md5(filepath)
+        proll, cur_fs = render_proll(
+            filepath, beat_subdivisions, fs, quantized, wrap)
+        # automatically appends .npy fo filename
+        np.save(filepath, proll)
+        # save image
+        if save_img:
+            plt.imsave(filepath+'_o.png', proll)
+            plt.imsave(filepath+'_f.png', np.flipud(proll))
+        return filepath, md5, cur_fs, proll.shape[1], None
+    except:
+        if debug:
+            traceback.print_exc()
+        return filepath, None, None, 0, str(sys.exc_info()[0])
+
+
+def main(globstr, beat_subdivisions, fs, quantized, wrap, save_img, debug,
+         n_jobs=1, manifest_path='midi2npyproll.json', force=False):
+    # conversion parameters, an output is reused only if these match
+    params = [beat_subdivisions, fs, quantized, wrap]
+    manifest = {} if force else load_manifest(manifest_path)
+
+    todo, n_skipped = [], 0
     for filepath in glob.glob(globstr):
-        try:
-            data = pm.PrettyMIDI(filepath)
-            b = data.get_beats()
-            beats = interpolate_between_beats(b, beat_subdivisions)
-            if quantized:
-                quantize(data, beats)
-            if not fs:
-                cur_fs = 1./beats[1]
-                while cur_fs > wrap:
-                    cur_fs = cur_fs * 0.5
-            else:
-                cur_fs = fs
-            print("{}, {}".format(filepath, cur_fs))
-            # proll = data.get_piano_roll(fs=fs, times=beats)
-            proll = data.get_piano_roll(fs=cur_fs).astype(int)
-            if np.isnan(proll).any():
-                print("{} had NaN cells".format(filepath))
-            # automatically appends .npy fo filename
-            np.save(filepath, proll)
-            # save image
-            if save_img:
-                plt.imsave(filepath+'_o.png', proll)
-                plt.imsave(filepath+'_f.png', np.flipud(proll))
-        except:
-            print filepath, sys.exc_info()[0]
-            if debug:
-                traceback.print_exc()
-            continue
+        entry = manifest.get(os.path.abspath(filepath))
+        if (entry is not None and entry['params'] == params and
+                os.path.exists(filepath + '.npy') and
+                entry['md5'] == file_md5(filepath)):
+            n_skipped += 1
+        else:
+            todo.append(filepath)
+    print("{} files to convert, {} up to date".format(len(todo), n_skipped))
+
+    job = functools.partial(convert, beat_subdivisions=beat_subdivisions,
+                            fs=fs, quantized=quantized, wrap=wrap,
+                            save_img=save_img, debug=debug)
+    if n_jobs > 1:
+        pool = mp.Pool(n_jobs)
+        results = pool.imap_unordered(job, todo)
+    else:
+        pool = None
+        results = (job(x) for x in todo)
+
+    failed, n_frames = [], 0
+    start_time = time.time()
+    try:
+        for i, (filepath, md5, cur_fs, frames, error) in enumerate(results):
+            if error is not None:
+                print("{}, {}".format(filepath, error))
+                failed.append(filepath)
+                continue
+            print("[{}/{}] {}, {}".format(i + 1, len(todo), filepath, cur_fs))
+            manifest[os.path.abspath(filepath)] = {
+                'md5': md5, 'params': params, 'fs': cur_fs}
+            n_frames += frames
+    finally:
+        if pool is not None:
+            pool.terminate()
+        save_manifest(manifest, manifest_path)
+
+    elapsed = time.time() - start_time
+    n_converted = len(todo) - len(failed)
+    print("converted {}, skipped {}, failed {} in {:.1f}s "
+          "({:.2f} files/s, {:.0f} frames/s)".format(
+              n_converted, n_skipped, len(failed), elapsed,
+              n_converted / max(elapsed, 1e-8),
+              n_frames / max(elapsed, 1e-8)))
+    for filepath in failed:
+        print("failed: {}".format(filepath))
+
+
+def render_cast(filepath, beat_subdivisions, fs, quantized, wrap, dtype,
+                debug):
+    # cast in the worker so only the final dtype goes through the pipe
+    try:
+        proll, cur_fs = render_proll(
+            filepath, beat_subdivisions, fs, quantized, wrap)
+        return filepath, proll.astype(dtype), cur_fs, None
+    except:
+        if debug:
+            traceback.print_exc()
+        return filepath, None, None, str(sys.exc_info()[0])
+
+
+def pack_midi_data(datapath, glob_file_str, corpus_path, beat_subdivisions,
+                   fs, quantized, wrap, dtype=np.float32, n_jobs=1,
+                   debug=False, block_size=65536):
+    """
+    Renders every MIDI file matching glob_file_str under datapath's composer
+    folders straight into a packed corpus readable by load_proll_corpus,
+    without writing per-file .npy arrays. Rolls are appended time-major to
+    corpus_path.part as they are rendered and transposed block-wise into the
+    pitch-major corpus_path.npy at the end. Rolls are stored unscaled, the
+    loaders crop and scale them on read.
+    """
+    filepaths, labels = glob_proll_files(datapath, glob_file_str)
+    if len(filepaths) == 0:
+        raise Exception("No files matching {} in {}".format(
+            glob_file_str, datapath))
+    composers = dict(zip(filepaths, labels))
+    # glob order depends on the file system, the corpus order must not
+    filepaths = sorted(filepaths)
+
+    job = functools.partial(
+        render_cast, beat_subdivisions=beat_subdivisions, fs=fs,
+        quantized=quantized, wrap=wrap, dtype=dtype, debug=debug)
+    if n_jobs > 1:
+        pool = mp.Pool(n_jobs)
+        results = pool.imap(job, filepaths)
+    else:
+        pool = None
+        results = (job(x) for x in filepaths)
+
+    # pieces are indexed in path order, whatever order they render in
+    packed, packed_fs, failed, lengths = [], [], [], [0]
+    pitch_counts = []
+    n_rows = None
+    start_time = time.time()
+    try:
+        with open(corpus_path + '.part', 'wb') as f:
+            for filepath, proll, cur_fs, error in results:
+                if error is not None:
+                    print("{}, {}".format(filepath, error))
+                    failed.append(filepath)
+                    continue
+                if n_rows is None:
+                    n_rows = proll.shape[0]
+                elif proll.shape[0] != n_rows:
+                    raise Exception("{} has {} rows, expected {}".format(
+                        filepath, proll.shape[0], n_rows))
+                np.ascontiguousarray(proll.T).tofile(f)
+                packed.append(filepath)
+                packed_fs.append(cur_fs)
+                lengths.append(proll.shape[1])
+                pitch_counts.append(proll_pitch_counts(proll))
+                print("[{}/{}] {}, {}".format(
+                    len(packed) + len(failed), len(filepaths), filepath,
+                    cur_fs))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if not packed:
+        os.remove(corpus_path + '.part')
+        raise Exception("No MIDI file in {} could be rendered".format(
+            datapath))
+
+    offsets = np.cumsum(lengths).astype(np.int64)
+    n_cols = int(offsets[-1])
+    part = np.memmap(corpus_path + '.part', dtype=dtype, mode='r',
+                     shape=(n_cols, n_rows))
+    corpus = np.lib.format.open_memmap(
+        corpus_path + '.npy', mode='w+', dtype=dtype, shape=(n_rows, n_cols))
+    for i in range(0, n_cols, block_size):
+        corpus[:, i:i+block_size] = part[i:i+block_size].T
+    corpus.flush()
+    del corpus, part
+    os.remove(corpus_path + '.part')
+
+    # the key covers failed files too, so it matches a glob of the sources
+    np.savez(corpus_path + '.idx.npz', offsets=offsets,
+             labels=np.array([composers[x] for x in packed]),
+             filepaths=np.array(packed), fs=np.array(packed_fs),
+             sources_key=sources_key(filepaths),
+             pitch_counts=np.array(pitch_counts))
+
+    elapsed = time.time() - start_time
+    print("packed {} pieces, {} frames, failed {} in {:.1f}s "
+          "({:.2f} files/s)".format(
+              len(packed), n_cols, len(failed), elapsed,
+              len(packed) / max(elapsed, 1e-8)))
+    for filepath in failed:
+        print("failed: {}".format(filepath))
 
 
 if __name__ == '__main__':
@@ -65,8 +264,31 @@ if __name__ == '__main__':
     parser.add_argument(
         "-d", "--debug", type=int, default=0,
         help="Print traceback for finding corrupt files")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=mp.cpu_count(),
+        help="Number of conversion processes")
+    parser.add_argument(
+        "-m", "--manifest", type=str, default='midi2npyproll.json',
+        help="Manifest of converted files and their parameters")
+    parser.add_argument(
+        "--force", type=int, default=0,
+        help="Convert every file, ignoring the manifest")
+    parser.add_argument(
+        "-p", "--pack", type=str, default='',
+        help="Render into this packed corpus instead of per-file arrays, "
+             "globstr is then matched inside the composer folders of "
+             "--datapath")
+    parser.add_argument(
+        "--datapath", type=str, default='',
+        help="Folder with one subfolder of MIDI files per composer")
 
     args = parser.parse_args()
     print(args)
-    main(args.globstr, args.beat_subdivisions, args.fs, args.quantized,
-         args.wrap, args.save_img, args.debug)
+    if args.pack:
+        pack_midi_data(args.datapath, args.globstr, args.pack,
+                       args.beat_subdivisions, args.fs, args.quantized,
+                       args.wrap, n_jobs=args.jobs, debug=args.debug)
+    else:
+        main(args.globstr, args.beat_subdivisions, args.fs, args.quantized,
+             args.wrap, args.save_img, args.debug, args.jobs, args.manifest,
+             args.force)
@@ -14,7 +14,7 @@ import pdb
 
 def train_sequence_rnn(data, layers, updates_fn, batch_size=16, epoch_size=128,
                        initial_patience=1000, improvement_threshold=0.99,
-                       patience_increase=5, max_iter=100000):
+                       patience_increase=5, max_iter=100000, n_buckets=8):
 
     # get input and mask vars from layers and specifiy output var
     input_var = layers[0].input_var
@@ -47,9 +47,11 @@ def train_sequence_rnn(data, layers, updates_fn, batch_size=16, epoch_size=128,
 
     # create data iterators
     print("Create data iterators")
-    train_data_iter = nnet_utils.get_next_batch_rnn(
+    train_data_iter = nnet_utils.get_bucketed_batch_rnn(
         data['train']['without_specs'], data['train']['with_specs'],
-        data['train']['masks'], batch_size, max_iter)
+        data['train']['masks'], batch_size, max_iter, n_buckets)
+    val_input, val_mask = nnet_utils.trim_to_mask(
+        data['validate']['without_specs'], data['validate']['masks'])
     patience = initial_patience
     current_val_cost = np.inf
     train_cost = 0.0
@@ -68,9 +70,9 @@ def train_sequence_rnn(data, layers, updates_fn, batch_size=16, epoch_size=128,
                             'validate_cost': 0.0,
                             'validate_objective': 0.0}
             # compute validation cost and objective
-            cost = np.float(validate_fn(data['validate']['without_specs'],
+            cost = np.float(validate_fn(val_input,
                                         data['validate']['with_specs'],
-                                        data['validate']['masks']))
+                                        val_mask))
             epoch_result['validate_cost'] = cost
             epoch_result['validate_objective'] = cost
 
@@ -113,7 +115,11 @@ def train_sequence_rnn(data, layers, updates_fn, batch_size=16, epoch_size=128,
 def train_rnn_proll(data_iter, layers, updates_fn, batch_size=32,
                     epoch_size=128, initial_patience=1000,
                     improvement_threshold=0.99, patience_increase=5,
-                    max_iter=100000):
+                    max_iter=100000, n_buckets=8):
+    """
+    data_iter['train'] is either a batch iterator or a dict of arrays as in
+    train_sequence_rnn, sampled in batches bucketed by mask length.
+    """
     # get input and mask vars from layers and specifiy output var
     input_var = layers[0].input_var
     mask_var = layers[1].input_var
@@ -149,11 +155,17 @@ def train_rnn_proll(data_iter, layers, updates_fn, batch_size=32,
     # val_pred_fn = theano.function([input_var, mask_var], val_prediction)
 
     # create data iterators
+    train_data_iter = data_iter['train']
+    if isinstance(train_data_iter, dict):
+        train_data_iter = nnet_utils.get_bucketed_batch_rnn(
+            train_data_iter['without_specs'], train_data_iter['with_specs'],
+            train_data_iter['masks'], batch_size, max_iter, n_buckets)
     patience = initial_patience
     current_val_cost = np.inf
     train_cost = 0.0
     print("Training and Validating ...")
-    for n, (x_batch, y_batch, mask_batch) in enumerate(data_iter['train']):
+    for n, (x_batch, y_batch, mask_batch) in enumerate(train_data_iter):
+        x_batch, mask_batch = nnet_utils.trim_to_mask(x_batch, mask_batch)
         train_cost_cur = train_fn(x_batch, y_batch, mask_batch)
         train_cost += train_cost_cur
         # train_pred = train_pred_fn(x_batch, mask_batch)
@@ -166,6 +178,7 @@ def train_rnn_proll(data_iter, layers, updates_fn, batch_size=32,
         if n and not (n % epoch_size):
             # compute validation cost and objective
             val_input, val_tgt, val_mask = data_iter['valid'].next()
+            val_input, val_mask = nnet_utils.trim_to_mask(val_input, val_mask)
             val_cost, val_err_rate = validate_fn(val_input, val_tgt, val_mask)
             val_cost = val_cost[0]
             val_err_rate = val_err_rate[0]
@@ -1,22 +1,76 @@
+import time
 import numpy as np
 import theano
 
 
-def get_next_batch(inputs, targets, batch_size, n_iters):
+def sample_batch_indices(n_samples, batch_size, n_iters, replace=False):
+    """
+    Yields n_iters batches of indices at O(batch_size) cost each. Without
+    replace, batches are consecutive slices of a permutation drawn once per
+    epoch, so no index repeats within an epoch and the few indices left
+    over at the end of the epoch are skipped. With replace, indices are
+    drawn independently.
+    """
+    batch_size = min(batch_size, n_samples)
+    order, pos = None, n_samples
     for _ in range(n_iters):
-        excerpt = np.random.permutation(len(inputs))[:batch_size]
+        if replace:
+            yield np.random.randint(0, n_samples, batch_size)
+            continue
+        if pos + batch_size > n_samples:
+            order, pos = np.random.permutation(n_samples), 0
+        yield order[pos:pos+batch_size]
+        pos += batch_size
+
+
+def get_next_batch(inputs, targets, batch_size, n_iters, replace=False):
+    for excerpt in sample_batch_indices(
+            len(inputs), batch_size, n_iters, replace):
         yield inputs[excerpt], targets[excerpt]
 
 
-def get_next_batch_rnn(inputs, targets, masks, batch_size, n_iters, conds=None):
-    for _ in range(n_iters):
-        excerpt = np.random.permutation(len(inputs))[:batch_size]
+def get_next_batch_rnn(inputs, targets, masks, batch_size, n_iters, conds=None,
+                       replace=False):
+    for excerpt in sample_batch_indices(
+            len(inputs), batch_size, n_iters, replace):
         if conds is None:
             yield inputs[excerpt], targets[excerpt], masks[excerpt]
         else:
             yield inputs[excerpt], targets[excerpt], masks[excerpt], conds[excerpt]
 
 
+def trim_to_mask(inputs, masks):
+    # drops the trailing steps that are masked out in every sequence, keeping
+    # one step when all masks are empty so the recurrent layers get input
+    used = np.flatnonzero(masks.any(axis=0))
+    n_steps = used[-1] + 1 if len(used) else 1
+    return inputs[:, :n_steps], masks[:, :n_steps]
+
+
+def get_bucketed_batch_rnn(inputs, targets, masks, batch_size, n_iters,
+                           n_buckets=8, replace=False):
+    """
+    Like get_next_batch_rnn, but indices for n_buckets batches are drawn at
+    once and grouped by mask length, and each batch is trimmed to its
+    longest mask so the recurrent layers do no work on padding.
+    """
+    lengths = masks.sum(axis=1)
+    n_pools = (n_iters + n_buckets - 1) // n_buckets
+    n_yielded = 0
+    for pool in sample_batch_indices(
+            len(inputs), batch_size * n_buckets, n_pools, replace):
+        pool = pool[np.argsort(lengths[pool], kind='mergesort')]
+        buckets = range(0, len(pool), batch_size)
+        for start in np.random.permutation(buckets):
+            if n_yielded == n_iters:
+                return
+            excerpt = pool[start:start+batch_size]
+            cur_inputs, cur_masks = trim_to_mask(
+                inputs[excerpt], masks[excerpt])
+            yield cur_inputs, targets[excerpt], cur_masks
+            n_yielded += 1
+
+
 def floatX(X):
     return np.asarray(X, dtype=theano.config.floatX)
 
@@ -27,3 +81,128 @@ def zerosX(X):
 
 def init_weights(shape):
     return theano.shared(floatX(np.random.randn(*shape) * 0.01))
+
+
+def split_threads(n_procs):
+    """
+    Gives each of n_procs processes forked afterwards an equal share of the
+    cores for BLAS and OpenMP, so they do not oversubscribe the machine.
+    The environment covers the OpenMP ops theano compiles and libraries
+    loaded later, MKL and, when installed, threadpoolctl resize the pools
+    already loaded. Returns the number of threads per process.
+    """
+    import os
+    import multiprocessing as mp
+    n_threads = max(1, mp.cpu_count() // n_procs)
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(n_threads)
+    try:
+        import mkl
+        mkl.set_num_threads(n_threads)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads)
+    except ImportError:
+        pass
+    return n_threads
+
+
+def time_steps(fns, step, n_steps):
+    """
+    Returns the seconds per call of step() over n_steps calls, after a
+    warm-up call. The shared variables of the theano functions fns, the
+    parameters, optimizer state and random streams they update, are restored
+    afterwards, so timing does not change the training run.
+    """
+    shared = []
+    for fn in fns:
+        shared.extend(x for x in fn.get_shared() if x not in shared)
+    values = [x.get_value() for x in shared]
+    try:
+        step()
+        start_time = time.time()
+        for _ in range(n_steps):
+            step()
+        return (time.time() - start_time) / n_steps
+    finally:
+        for x, value in zip(shared, values):
+            x.set_value(value)
+
+
+class ProcessBarrier():
+    """
+    Reusable barrier for n forked processes, built from semaphores since
+    Python 2 multiprocessing has none. After abort(), waits in any process
+    raise instead of blocking on a process that died.
+    """
+    def __init__(self, n):
+        import multiprocessing as mp
+        self.n = n
+        self.count = mp.Value('i', 0)
+        self.broken = mp.Value('b', 0, lock=False)
+        self.turnstiles = (mp.Semaphore(0), mp.Semaphore(0))
+
+    def pass_turnstile(self, turnstile, delta, last):
+        with self.count.get_lock():
+            self.count.value += delta
+            if self.count.value == last:
+                for _ in range(self.n):
+                    turnstile.release()
+        while not turnstile.acquire(timeout=1.):
+            if self.broken.value:
+                raise Exception("Barrier aborted")
+
+    def wait(self):
+        self.pass_turnstile(self.turnstiles[0], 1, self.n)
+        self.pass_turnstile(self.turnstiles[1], -1, 0)
+
+    def abort(self):
+        self.broken.value = 1
+
+
+class ParameterAverager():
+    """
+    Averages the theano shared variables params of n_procs forked
+    processes through shared memory. In average(rank), each process copies
+    its values to its row of the buffer, averages its share of the columns
+    over all rows and reads the full average back, so all processes leave
+    with the same values. Must be created before the processes are forked.
+    sync_time is the time spent in average(), waiting included.
+
+    This averages parameters after each process took its own optimizer step,
+    not gradients before a shared one. Optimizer state, e.g. Adam moments,
+    stays local to each process. With plain SGD averaging after every step
+    equals a step on the averaged gradient, with adaptive optimizers it does
+    not.
+    """
+    def __init__(self, params, n_procs, barrier=None):
+        from multiprocessing.sharedctypes import RawArray
+        self.params = params
+        sizes = [p.get_value(borrow=True).size for p in params]
+        self.offsets = np.cumsum([0] + sizes)
+        n_values = int(self.offsets[-1])
+        # one row per process and a last row for the average
+        self.buffer = RawArray('f', (n_procs + 1) * n_values)
+        self.values = np.frombuffer(self.buffer, dtype=np.float32).reshape(
+            (n_procs + 1, n_values))
+        self.bounds = np.linspace(0, n_values, n_procs + 1).astype(int)
+        self.barrier = barrier or ProcessBarrier(n_procs)
+        self.sync_time = 0.
+
+    def average(self, rank):
+        start_time = time.time()
+        row = self.values[rank]
+        slices = list(zip(self.params, self.offsets[:-1], self.offsets[1:]))
+        for param, start, end in slices:
+            row[start:end] = param.get_value(borrow=True).ravel()
+        self.barrier.wait()
+        start, end = self.bounds[rank], self.bounds[rank + 1]
+        self.values[-1, start:end] = self.values[:-1, start:end].mean(axis=0)
+        self.barrier.wait()
+        for param, start, end in slices:
+            value = param.get_value(borrow=True)
+            param.set_value(self.values[-1, start:end].reshape(
+                value.shape).astype(value.dtype))
+        self.sync_time += time.time() - start_time
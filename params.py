@@ -46,8 +46,9 @@ nnet_params = {
                  },
     'rnn': {'batch_size': batch_size,
             'epoch_size': epoch_size,
-            'input_shape': (batch_size, n_timesteps, n_features),
-            'mask_shape': (batch_size, n_timesteps),
+            # variable time steps, batches are trimmed to their masks
+            'input_shape': (batch_size, None, n_features),
+            'mask_shape': (batch_size, None),
             'n_hidden': 1024,
             'grad_clip': 100,
             'init': lasagne.init.HeUniform(),
@@ -58,8 +59,9 @@ nnet_params = {
             },
     'rnn_proll': {'batch_size': batch_size,
                   'epoch_size': epoch_size,
-                  'input_shape': (batch_size, n_timesteps, n_features),
-                  'mask_shape': (batch_size, n_timesteps),
+                  # variable time steps, batches are trimmed to their masks
+                  'input_shape': (batch_size, None, n_features),
+                  'mask_shape': (batch_size, None),
                   'n_hidden': 128,
                   'grad_clip': 100,
                   'init': lasagne.init.HeUniform(),
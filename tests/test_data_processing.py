@@ -0,0 +1,347 @@
+import os
+import numpy as np
+import pytest
+
+from data_processing import (
+    BatchPrefetcher, ProllCorpus, SharedBatchProducer, TextCorpus,
+    augment_proll_batch, iterate_composer_windows, iterate_minibatches_proll,
+    iterate_minibatches_text, load_proll_data, load_text_corpus,
+    load_text_data)
+from text_utils import binarizeBatch, textEncoder
+
+
+@pytest.fixture
+def proll_dir(tmpdir):
+    # velocities below the threshold are silent once scaled
+    rng = np.random.RandomState(0)
+    for composer in ('bach', 'chopin'):
+        os.makedirs(str(tmpdir.join('rolls', composer)))
+        for i in range(3):
+            proll = np.zeros((128, 200))
+            proll[40:90] = rng.randint(0, 20, (50, 200))
+            proll[60:70] = rng.randint(60, 100, (10, 200))
+            # the loudest notes are outside of the (32, 96) crop
+            proll[100:104] = rng.randint(100, 128, (4, 200))
+            np.save(str(tmpdir.join('rolls', composer, '{}.npy'.format(i))),
+                    proll)
+    return str(tmpdir.join('rolls'))
+
+
+def load_both(proll_dir, corpus_path, crop, **kwargs):
+    raw, raw_labels = load_proll_data(proll_dir, '*.npy', 0, crop,
+                                      as_dict=False, **kwargs)
+    packed, packed_labels = load_proll_data(
+        proll_dir, '*.npy', 0, crop, as_dict=False, corpus_path=corpus_path,
+        **kwargs)
+    assert list(raw_labels) == list(packed_labels)
+    return raw, packed
+
+
+@pytest.mark.parametrize('crop', [None, (32, 96)])
+@pytest.mark.parametrize('threshold', [0, 0.5])
+@pytest.mark.parametrize('scale', [True, False])
+def test_packed_parity(proll_dir, tmpdir, crop, threshold, scale):
+    # the packed path crops, then scales, as the raw path does
+    raw, packed = load_both(proll_dir, str(tmpdir.join('corpus')), crop,
+                            threshold=threshold, scale=scale)
+    assert len(raw) == len(packed)
+    for i in range(len(raw)):
+        assert raw[i].dtype == packed[i].dtype
+        assert np.array_equal(raw[i], packed[i])
+
+
+@pytest.mark.parametrize('crop', ['auto', 8])
+@pytest.mark.parametrize('threshold', [0, 0.3])
+def test_crop_parity(proll_dir, tmpdir, capsys, crop, threshold):
+    # the raw and the packed path choose the same crop from the same
+    # statistics and return the same rolls
+    raw, packed = load_both(proll_dir, str(tmpdir.join('corpus')), crop,
+                            threshold=threshold)
+    raw_out, packed_out = capsys.readouterr().out.splitlines()
+    assert raw_out.startswith('Pitch crop')
+    assert raw_out == packed_out
+    for i in range(len(raw)):
+        assert np.array_equal(raw[i], packed[i])
+
+
+def test_minibatches_proll_skip_short_pieces():
+    # windows are only drawn from pieces at least a window long
+    rng = np.random.RandomState(0)
+    pieces = [rng.rand(8, n).astype(np.float32) for n in (30, 200, 63)]
+    lengths = np.array([30, 200, 63])
+    corpus = ProllCorpus(np.concatenate(pieces, axis=1),
+                         np.cumsum(lengths) - lengths, lengths)
+    labels = np.arange(3)
+    batches = iterate_minibatches_proll(corpus, labels, 16, length=64, seed=0)
+    for _ in range(10):
+        data, batch_labels = next(batches)
+        assert (batch_labels == 1).all()
+        for window in data:
+            assert any(np.array_equal(window, pieces[1][:, i:i+64])
+                       for i in range(200 - 64 + 1))
+    with pytest.raises(Exception):
+        next(iterate_minibatches_proll(corpus, labels, 16, length=256))
+
+
+@pytest.mark.parametrize('padding', ['zero', 'noise', 'repeat'])
+def test_minibatches_text_skip_empty_texts(padding):
+    # empty texts are dropped with their labels rather than padded with
+    # codes of the neighbouring texts
+    lengths = np.array([5, 0, 3, 0])
+    corpus = TextCorpus(np.arange(8, dtype=np.uint8) % 4,
+                        np.cumsum(lengths) - lengths, lengths)
+    encoder = textEncoder(['a', 'b', 'c'])
+    data, labels = next(iterate_minibatches_text(
+        corpus, np.arange(4), 4, encoder, shuffle=False, length=12,
+        alphabet_size=4, padding=padding, seed=0))
+    assert list(labels) == [0, 2]
+    out = np.empty((2, 4, 12), dtype=np.float32)
+    expected = binarizeBatch(corpus.codes, corpus.starts[[0, 2]],
+                             lengths[[0, 2]], 12, out, padding,
+                             np.random.RandomState(0))
+    # noise draws differ, they are far below the one-hot values
+    assert np.allclose(data, expected, atol=0.01)
+    if padding == 'repeat':
+        # the text, a one step gap, then the text repeated
+        assert list(data[1].argmax(axis=0)[:9]) == [1, 2, 3, 0, 1, 2, 3, 1, 2]
+        assert (data[1, :, 3] == -1).all()
+
+
+def take(batches, n):
+    # the iterators reuse their output buffers
+    return [tuple(np.array(x) for x in next(batches)) for _ in range(n)]
+
+
+@pytest.fixture
+def proll_corpus():
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(64, 300, 12)
+    return (ProllCorpus(rng.rand(8, lengths.sum()).astype(np.float32),
+                        np.cumsum(lengths) - lengths, lengths),
+            np.arange(12))
+
+
+@pytest.fixture
+def text_corpus():
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(1, 100, 40)
+    encoder = textEncoder([chr(x) for x in range(97, 123)])
+    corpus = TextCorpus(rng.randint(0, 27, lengths.sum()).astype(np.uint8),
+                        np.cumsum(lengths) - lengths, lengths)
+    return corpus, np.arange(40), encoder
+
+
+def proll_batches(proll_corpus, **kwargs):
+    inputs, labels = proll_corpus
+    return iterate_minibatches_proll(inputs, labels, 4, length=32, seed=7,
+                                     max_shift=2, max_stretch=2, **kwargs)
+
+
+def text_batches(text_corpus, **kwargs):
+    inputs, labels, encoder = text_corpus
+    return iterate_minibatches_text(inputs, labels, 4, encoder, length=32,
+                                    alphabet_size=27, padding='noise',
+                                    seed=7, **kwargs)
+
+
+@pytest.mark.parametrize('corpus, make_batches', [
+    ('proll_corpus', proll_batches), ('text_corpus', text_batches)])
+def test_batches_seekable(request, corpus, make_batches):
+    # batch k of a seeded stream is the first batch from start=k, and
+    # worker w of n yields batches w, w+n, ... of the stream
+    corpus = request.getfixturevalue(corpus)
+    stream = take(make_batches(corpus), 24)
+    for k in (0, 1, 9, 23):
+        batch = take(make_batches(corpus, start=k), 1)[0]
+        assert all(np.array_equal(x, y) for x, y in zip(batch, stream[k]))
+    n_workers = 3
+    for worker_id in range(n_workers):
+        batches = take(make_batches(corpus, start=worker_id, step=n_workers),
+                       24 // n_workers)
+        for batch, expected in zip(batches, stream[worker_id::n_workers]):
+            assert all(np.array_equal(x, y) for x, y in zip(batch, expected))
+
+
+def test_shared_batch_producer_order(proll_corpus):
+    # workers owning every n_workers-th batch are read back in stream order
+    stream = take(proll_batches(proll_corpus), 20)
+    n_workers = 3
+    producer = SharedBatchProducer(
+        lambda worker_id: proll_batches(
+            proll_corpus, start=worker_id, step=n_workers),
+        n_workers, n_slots=6)
+    try:
+        batches = take(producer, 20)
+    finally:
+        producer.close()
+    for batch, expected in zip(batches, stream):
+        assert all(np.array_equal(x, y) for x, y in zip(batch, expected))
+
+
+@pytest.mark.parametrize('kind', ['sparse', 'bits'])
+@pytest.mark.parametrize('threshold', [0, 0.5])
+def test_derived_corpus_stored(proll_dir, tmpdir, kind, threshold):
+    # sparse and bit-packed corpora are built once next to the packed
+    # corpus, without a dense scaled copy, and match the ones built from the
+    # files
+    corpus_path = str(tmpdir.join('corpus'))
+    raw, packed = load_both(proll_dir, corpus_path, (32, 96),
+                            threshold=threshold, **{kind: True})
+    stored = sorted(tmpdir.listdir(lambda x: x.basename.startswith('corpus')))
+    assert sorted(x.basename.split('_')[0] for x in stored) == sorted([
+        'corpus.idx.npz', 'corpus.npy', 'corpus.' + kind])
+    _, again = load_both(proll_dir, corpus_path, (32, 96),
+                         threshold=threshold, **{kind: True})
+    assert sorted(tmpdir.listdir(
+        lambda x: x.basename.startswith('corpus'))) == stored
+    for i in range(len(raw)):
+        assert np.array_equal(raw[i], packed[i])
+        assert np.array_equal(raw[i], again[i])
+
+
+@pytest.mark.parametrize('n_pieces', [0, 3])
+def test_text_n_pieces_per_file(tmpdir, n_pieces):
+    # both text loaders keep n_pieces random texts of each file
+    datapaths = []
+    for i, n_texts in enumerate((5, 8)):
+        datapaths.append(str(tmpdir.join('{}.csv'.format(i))))
+        with open(datapaths[-1], 'w') as f:
+            f.write('label,text\n')
+            for j in range(n_texts):
+                f.write('{},{}\n'.format(i, 'ab' * (j + 1) + 'c' * i))
+    encoder = textEncoder(['a', 'b', 'c'])
+    cols = (1, 1), (0, 0)
+    np.random.seed(0)
+    texts, labels = load_text_data(datapaths, cols[0], cols[1], n_pieces,
+                                   as_dict=False)
+    np.random.seed(0)
+    corpus, corpus_labels = load_text_corpus(
+        datapaths, cols[0], cols[1], n_pieces, encoder,
+        str(tmpdir.join('cache')))
+    assert [(labels == i).sum() for i in (0, 1)] == (
+        [n_pieces] * 2 if n_pieces else [5, 8])
+    assert list(corpus_labels) == list(labels)
+    decoded = [''.join(encoder.decode(corpus[i])) for i in range(len(corpus))]
+    assert decoded == list(texts)
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_batch_prefetcher(n_workers):
+    # every batch comes out once, in order with a single worker, then the
+    # prefetcher stops
+    batches = BatchPrefetcher(iter(range(50)), depth=4, n_workers=n_workers)
+    out = list(batches)
+    assert out == list(range(50)) if n_workers == 1 else (
+        sorted(out) == list(range(50)))
+    assert batches.stats()['batches'] == 50
+    with pytest.raises(StopIteration):
+        next(batches)
+
+
+def test_batch_prefetcher_exception():
+    # an error of the generator is raised in the consumer after the batches
+    # built before it
+    def generator():
+        for i in range(3):
+            yield i
+        raise ValueError("bad piece")
+    batches = BatchPrefetcher(generator(), depth=2)
+    assert [next(batches) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(batches)
+    with pytest.raises(StopIteration):
+        next(batches)
+
+
+def shifted(roll, shift, fill):
+    out = np.full_like(roll, fill)
+    if shift >= 0:
+        out[shift:] = roll[:len(roll) - shift]
+    else:
+        out[:shift] = roll[-shift:]
+    return out
+
+
+def test_augment_proll_batch():
+    rng = np.random.RandomState(0)
+    batch = -np.ones((16, 12, 20), dtype=np.float32)
+    batch[:, 4:7] = rng.choice([-1, 1], (16, 3, 20))
+    # notes on the edge rows can not move past them
+    batch[0, 0] = batch[1, 11] = 1
+    assert np.array_equal(augment_proll_batch(batch, rng=rng), batch)
+    # each roll is transposed by up to max_shift rows without losing notes
+    out = augment_proll_batch(batch, max_shift=3, rng=rng)
+    n_shifted = 0
+    for roll, aug in zip(batch, out):
+        assert (aug == 1).sum() == (roll == 1).sum()
+        shifts = [x for x in range(-3, 4)
+                  if np.array_equal(aug, shifted(roll, x, -1))]
+        assert shifts
+        n_shifted += 0 not in shifts
+    assert n_shifted
+    assert np.array_equal(out[0, 0], batch[0, 0])
+    assert np.array_equal(out[1, 11], batch[1, 11])
+    # and stretched in time by repeating each frame 1 to max_stretch times
+    out = augment_proll_batch(batch, max_stretch=3, rng=rng)
+    frames = np.arange(20)
+    for roll, aug in zip(batch, out):
+        assert any(np.array_equal(aug, roll[:, frames // x])
+                   for x in (1, 2, 3))
+
+
+def window_corpus():
+    # row 0 holds the piece id and row 1 the frame within the piece
+    lengths = np.array([40, 30, 60, 8, 50, 45])
+    data = np.zeros((3, lengths.sum()), dtype=np.float32)
+    starts = np.cumsum(lengths) - lengths
+    for i, (start, n) in enumerate(zip(starts, lengths)):
+        data[0, start:start+n] = i
+        data[1, start:start+n] = np.arange(n)
+    labels = np.array(['bach', 'chopin', 'bach', 'chopin', 'chopin', 'bach'])
+    return ProllCorpus(data, starts, lengths), labels
+
+
+@pytest.mark.parametrize('single_len', [True, False])
+def test_iterate_composer_windows(single_len):
+    corpus, labels = window_corpus()
+    np.random.seed(0)
+    batches = iterate_composer_windows(corpus, 8, 4, 16, clip=True,
+                                       single_len=single_len, labels=labels)
+    for _ in range(20):
+        inputs, conds, masks = next(batches)
+        assert inputs.shape == (8, 16, 3)
+        assert conds.shape == (8, 16, 2)
+        mask_sizes = masks.sum(axis=1)
+        assert ((mask_sizes >= 4) & (mask_sizes < 16)).all()
+        assert (len(set(mask_sizes)) == 1) or not single_len
+        for window, cond, mask, size in zip(inputs, conds, masks,
+                                            mask_sizes):
+            assert (mask[:size] == 1).all() and (mask[size:] == 0).all()
+            # clipped steps are zeroed, the others are consecutive frames
+            # of one piece, whose composer is the condition
+            assert (window[size:] == 0).all()
+            piece = int(window[0, 0])
+            assert (window[:size, 0] == piece).all()
+            assert np.array_equal(np.diff(window[:size, 1]), np.ones(size - 1))
+            assert window[0, 1] + 16 <= corpus.lengths[piece] - 2
+            assert piece != 3
+            assert (cond == (np.unique(labels) == labels[piece])).all()
+
+
+def test_iterate_composer_windows_dict():
+    # a dict of composer to time-major pieces gives the same windows
+    corpus, labels = window_corpus()
+    data = {}
+    for i, label in enumerate(labels):
+        data.setdefault(label, []).append(corpus[i].T)
+    for kwargs in ({}, {'single_len': False, 'trim': True, 'n_buckets': 3}):
+        np.random.seed(0)
+        expected = take(iterate_composer_windows(
+            corpus, 8, 4, 16, labels=labels, **kwargs), 6)
+        np.random.seed(0)
+        batches = take(iterate_composer_windows(data, 8, 4, 16, **kwargs), 6)
+        for batch, other in zip(batches, expected):
+            assert all(np.array_equal(x, y) for x, y in zip(batch, other))
+            if kwargs:
+                # trimmed to the longest mask of the batch
+                assert batch[0].shape[1] == batch[2].sum(axis=1).max()
@@ -0,0 +1,124 @@
+import multiprocessing as mp
+import numpy as np
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from nnet_utils import (
+    ParameterAverager, ProcessBarrier, get_bucketed_batch_rnn, time_steps,
+    trim_to_mask)
+
+
+def average_values(averager, params, rank, out):
+    # each process holds known values, then reports what it holds afterwards
+    for i, param in enumerate(params):
+        param.set_value(np.full(param.get_value().shape, rank * (i + 1),
+                                dtype=np.float32))
+    averager.average(rank)
+    out.put((rank, [param.get_value() for param in params]))
+
+
+def test_parameter_averager():
+    # every process leaves with the mean over processes of every parameter
+    n_procs = 4
+    params = [theano.shared(np.zeros((3, 5), dtype=np.float32)),
+              theano.shared(np.zeros(7, dtype=np.float32))]
+    averager = ParameterAverager(params, n_procs)
+    out = mp.Queue()
+    procs = [mp.Process(target=average_values,
+                        args=(averager, params, rank, out))
+             for rank in range(1, n_procs)]
+    for proc in procs:
+        proc.start()
+    average_values(averager, params, 0, out)
+    results = dict(out.get(timeout=30) for _ in range(n_procs))
+    for proc in procs:
+        proc.join()
+    mean_rank = np.mean(range(n_procs))
+    for rank in range(n_procs):
+        for i, value in enumerate(results[rank]):
+            assert value.shape == params[i].get_value().shape
+            assert np.allclose(value, mean_rank * (i + 1))
+
+
+def wait_twice(barrier, arrived, out):
+    # no process passes a wait before all processes reached it
+    seen = []
+    for _ in range(2):
+        with arrived.get_lock():
+            arrived.value += 1
+        barrier.wait()
+        seen.append(arrived.value)
+    out.put(seen)
+
+
+def test_process_barrier():
+    n_procs = 3
+    barrier = ProcessBarrier(n_procs)
+    arrived = mp.Value('i', 0)
+    out = mp.Queue()
+    procs = [mp.Process(target=wait_twice, args=(barrier, arrived, out))
+             for _ in range(n_procs)]
+    for proc in procs:
+        proc.start()
+    results = [out.get(timeout=30) for _ in range(n_procs)]
+    for proc in procs:
+        proc.join()
+    for seen in results:
+        assert seen[0] >= n_procs
+        assert seen[1] == 2 * n_procs
+    # an aborted barrier raises instead of waiting for the missing processes
+    barrier = ProcessBarrier(2)
+    barrier.abort()
+    with pytest.raises(Exception):
+        barrier.wait()
+
+
+def test_time_steps_restores_state():
+    param = theano.shared(np.zeros(4, dtype=np.float32))
+    count = theano.shared(np.int64(0))
+    fn = theano.function([], [], updates=[(param, param + 1),
+                                          (count, count + 1)])
+    assert time_steps([fn], fn, n_steps=3) >= 0
+    assert np.array_equal(param.get_value(), np.zeros(4))
+    assert count.get_value() == 0
+
+
+def test_trim_to_mask():
+    inputs = np.arange(24).reshape((2, 6, 2))
+    masks = np.array([[1, 1, 0, 0, 0, 0], [1, 1, 1, 0, 0, 0]])
+    trimmed, trimmed_masks = trim_to_mask(inputs, masks)
+    assert np.array_equal(trimmed, inputs[:, :3])
+    assert np.array_equal(trimmed_masks, masks[:, :3])
+    # one step is kept when every mask is empty
+    trimmed, trimmed_masks = trim_to_mask(inputs, np.zeros_like(masks))
+    assert trimmed.shape == (2, 1, 2) and trimmed_masks.shape == (2, 1)
+
+
+def test_get_bucketed_batch_rnn():
+    # batches of similar lengths, trimmed to their longest mask, with the
+    # targets of their inputs and no sample twice within an epoch
+    rng = np.random.RandomState(0)
+    n_samples, max_len = 64, 30
+    lengths = rng.randint(1, max_len + 1, n_samples)
+    masks = (np.arange(max_len)[None, :] < lengths[:, None]).astype(np.int32)
+    inputs = np.repeat(np.arange(n_samples)[:, None], max_len, axis=1)
+    inputs = inputs[:, :, None] * masks[:, :, None]
+    targets = np.arange(n_samples)
+    np.random.seed(0)
+    batches = list(get_bucketed_batch_rnn(inputs, targets, masks, 4, 16,
+                                          n_buckets=4))
+    assert len(batches) == 16
+    seen = []
+    for batch_inputs, batch_targets, batch_masks in batches:
+        assert batch_inputs.shape[1] == lengths[batch_targets].max()
+        assert np.array_equal(batch_masks, masks[batch_targets][
+            :, :batch_inputs.shape[1]])
+        assert np.array_equal(batch_inputs[:, 0, 0], batch_targets)
+        seen.extend(batch_targets)
+    assert sorted(seen) == list(range(n_samples))
+    # the batches drawn together cover disjoint ranges of lengths
+    for i in range(0, 16, 4):
+        ranges = sorted((lengths[x[1]].min(), lengths[x[1]].max())
+                        for x in batches[i:i+4])
+        assert all(a[1] <= b[0] for a, b in zip(ranges, ranges[1:]))
@@ -36,8 +36,8 @@ def removeStopwords(l_words, lang='english'):
 
 def binarizeText(text, encoder, lower_case=True, remove_stopwords=False,
                  remove_html=True):
-    from bs4 import BeautifulSoup
     if remove_html:
+        from bs4 import BeautifulSoup
         try:
             text = BeautifulSoup(text, 'lxml').get_text()
         except:
@@ -51,7 +51,50 @@ def binarizeText(text, encoder, lower_case=True, remove_stopwords=False,
         text = removeStopwords(text.split(' '))
     text = np.array(encoder.encode(preprocess(text)), dtype=int)
     # +1 for dustbin
-    return np.eye(len(encoder.alphabet)+1, dtype=int)[:, text]
+    binarized = np.zeros((len(encoder.alphabet)+1, len(text)), dtype=int)
+    binarized[text, np.arange(len(text))] = 1
+    return binarized
+
+
+def binarizeBatch(codes, starts, lengths, length, out, padding=None,
+                  rng=np.random):
+    """
+    One-hot encodes a batch of code sequences, sequence i being
+    codes[starts[i]:starts[i]+lengths[i]], into out, a
+    (n_samples, alphabet_size, length) float32 buffer, as -1/+1 values.
+    Longer sequences are randomly sliced. Shorter sequences are dropped when
+    padding is None, otherwise padded with 'zero', 'noise' or 'repeat'.
+    Empty sequences are always dropped. Random draws come from rng. Returns
+    the filled rows of out.
+    """
+    if padding not in (None, 'zero', 'noise', 'repeat'):
+        raise Exception("Padding {} not supported".format(padding))
+    keep = lengths >= (length if padding is None else 1)
+    starts, lengths = starts[keep], lengths[keep]
+    out = out[:len(lengths)]
+
+    steps = np.arange(length)[None, :]
+    n = lengths[:, None]
+    # random slice start for sequences longer than length
+    slice_starts = (rng.uniform(size=n.shape) *
+                    np.maximum(n - length, 0)).astype(np.int64)
+    src = slice_starts + steps
+    valid = src < n
+    if padding == 'repeat':
+        # repeat the sequence after a one step gap, as the original padding
+        k = steps - n
+        repeat = (k >= 1) & (k < length - n - 1)
+        src = np.where(repeat, (k - 1) % np.maximum(n, 1), src)
+        valid |= repeat
+
+    out.fill(-1)
+    rows, cols = np.nonzero(valid)
+    out[rows, codes[starts[rows] + src[rows, cols]], cols] = 1
+    if padding == 'noise':
+        # noise on every symbol of the padded steps, scaled to [-1, 1]
+        out += (rng.normal(0, 0.0002, out.shape) *
+                (steps >= n)[:, None, :])
+    return out
 
 
 class textEncoder():
@@ -63,13 +106,73 @@ class textEncoder():
         for i in range(len(alphabet)):
             self.encoder[alphabet[i]] = i
             self.decoder[i] = alphabet[i]
+        self.build_tables()
+
+    def build_tables(self):
+        """
+        256-entry byte to code lookup table, unknown bytes go to the dustbin
+        code len(encoder), and a code to character table for decoding.
+        """
+        dustbin = len(self.encoder)
+        dtype = np.uint8 if dustbin < 256 else np.int32
+        self.encode_table = np.zeros(256, dtype=dtype) + dustbin
+        for x, i in self.encoder.items():
+            if len(x) == 1 and ord(x) < 256:
+                self.encode_table[ord(x)] = i
+        chars = [self.decoder[i] for i in range(len(self.decoder))]
+        self.decode_table = np.array(chars + [self.out])
+        if self.decode_table.dtype.itemsize != np.array(['#']).itemsize:
+            # multi-character symbols are joined as objects
+            self.decode_table = self.decode_table.astype(object)
+
+    def __getstate__(self):
+        # keep pickles identical to the dict based encoder
+        state = self.__dict__.copy()
+        state.pop('encode_table', None)
+        state.pop('decode_table', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_tables()
 
     def encode(self, data):
-        return [self.encoder[x]
-                if x in self.encoder else len(self.encoder)
-                for x in data]
+        if isinstance(data, bytes):
+            codes = np.frombuffer(data, dtype=np.uint8)
+            return self.encode_table[codes]
+        codes = np.frombuffer(data.encode('utf-32-le'), dtype=np.uint32)
+        return np.where(codes < 256, self.encode_table[codes & 255],
+                        len(self.encoder)).astype(self.encode_table.dtype)
+
+    def encode_batch(self, data):
+        """
+        Encodes a sequence of strings with a single table lookup. Returns the
+        concatenated codes and the offsets of each string within them.
+        """
+        lengths = np.array([len(x) for x in data], dtype=np.int64)
+        offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        if len(data) and isinstance(data[0], bytes):
+            codes = self.encode(b''.join(data))
+        else:
+            codes = self.encode(u''.join(data))
+        return codes, offsets
+
+    def decode_indices(self, data):
+        data = np.asarray(data)
+        n_codes = len(self.decode_table) - 1
+        return np.where((data >= 0) & (data < n_codes), data, n_codes)
 
     def decode(self, data):
-        return [self.decoder[x]
-                if x in self.decoder else self.out
-                for x in data]
+        return list(self.decode_table[self.decode_indices(data)])
+
+    def decode_batch(self, data):
+        """
+        Decodes a (n_samples, length) array of codes into a list of strings.
+        """
+        chars = self.decode_table[self.decode_indices(data)]
+        if chars.dtype == object or chars.shape[1] == 0:
+            return [''.join(row) for row in chars]
+        chars = np.ascontiguousarray(chars)
+        return [str(x) for x in chars.view(
+            '{}{}'.format(chars.dtype.kind, chars.shape[1])).ravel()]